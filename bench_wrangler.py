@@ -0,0 +1,372 @@
+"""benchmarks
+
+Run with `python bench_wrangler.py` to generate a synthetic stack and
+measure parse, translate and write throughput separately, along with
+the per-script cost of translating with the original per-call dispatch
+against the compiled render path, and the import time of `wrangler`.
+Results are printed as JSON so runs can be saved with `--json` and
+compared across commits with `--compare`.
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+import yaml
+
+from wrangler import LuaTranslator, Script, parse_scripts, write_scripts_to_files
+
+SAMPLE = """
+^pre: &pre
+  - modulepaths:
+      - /opt/modulefiles/core
+    modules:
+      - PrgEnv-intel/${PrgEnv_intel_ver}
+      - craype/${craype_ver}
+      - intel/${intel_ver}
+^post: &post
+  - modulepaths:
+      - None
+    modules:
+      - prod_util/${prod_util_ver}
+prep:
+  help: Load environment to run prep job on WCOSS2
+  whatis: prep run environment
+  content:
+    - <<: *pre
+    - modulepaths:
+        - None
+      modules:
+        - hdf5/${hdf5_ver}
+        - python/3.8.5
+        - netcdf/${netcdf_ver}
+        - crtm/${crtm_ver}
+    - modulepaths:
+        - /lfs/h2/emc/global/save/emc.global/git/prepobs/module
+      modules:
+        - prepobs/${prepobs_ver}
+      environment:
+        - a: extra1
+        - b: extra1
+    - <<: *post
+"""
+
+
+class LegacyLuaTranslator(LuaTranslator):
+    """LuaTranslator with the original per-call dispatch map"""
+
+    def __call__(self, key, value):
+        _map = {
+            "modules": self.modules,
+            "modulepaths": self.module_paths,
+            "environment": self.environment,
+            "help": self._help,
+            "whatis": self.what_is,
+        }
+        return _map.get(key, lambda x: x)(value)
+
+
+def legacy_render(data, translator) -> str:
+    """renders data the way Script and write_scripts_to_files originally did"""
+    content = list(
+        itertools.chain(
+            *[
+                translator(key, content)
+                for item in data.get("content", [])
+                for key, content in item.items()
+            ]
+        )
+    )
+    buffer = io.StringIO()
+    buffer.writelines(
+        itertools.chain(
+            translator("help", data.get("help", None)),
+            content,
+            translator("whatis", data.get("whatis", None)),
+        )
+    )
+    return buffer.getvalue()
+
+
+def generate_stack(
+    root: Path,
+    files: int = 10,
+    scripts: int = 50,
+    modules: int = 8,
+    modulepaths: int = 2,
+    anchors: int = 2,
+    merge_density: float = 0.5,
+    seed: int = 0,
+) -> list[Path]:
+    """writes a synthetic stack of yaml files under root and returns their paths
+
+    Each file defines `anchors` `^` templates and `scripts` scripts.  Every
+    script loads `modules` modules from `modulepaths` module paths of its
+    own, and merges each template with probability `merge_density`.
+    """
+    rng = random.Random(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for file_idx in range(files):
+        lines = []
+        for anchor in range(anchors):
+            lines += [f"^template{anchor}: &template{anchor}", "  - modulepaths:"]
+            lines += [
+                f"      - /opt/template{anchor}/{idx}" for idx in range(modulepaths)
+            ]
+            lines += ["    modules:"]
+            lines += [
+                f"      - tmpl{anchor}_{idx}/${{tmpl{anchor}_{idx}_ver}}"
+                for idx in range(modules)
+            ]
+        for script in range(scripts):
+            lines += [
+                f"stack{file_idx}_script{script}:",
+                f"  help: Load environment for script {script} of file {file_idx}",
+                f"  whatis: script {script} run environment",
+                "  content:",
+            ]
+            lines += [
+                f"    - <<: *template{anchor}"
+                for anchor in range(anchors)
+                if rng.random() < merge_density
+            ]
+            lines += ["    - modulepaths:"]
+            lines += [
+                f"        - /lfs/h2/stack{file_idx}/{script}/{idx}"
+                for idx in range(modulepaths)
+            ] or ["        - None"]
+            lines += ["      modules:"]
+            lines += [
+                f"        - lib{idx}/${{lib{idx}_ver}}" for idx in range(modules)
+            ] or ["        - base"]
+            lines += ["      environment:", f"        - STACK_SCRIPT: '{script}'"]
+        path = root / f"stack{file_idx}.yaml"
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        paths.append(path)
+    return paths
+
+
+def phase(seconds: float, scripts: int, size: int) -> dict[str, float]:
+    """returns the throughput of one benchmark phase"""
+    return {
+        "seconds": seconds,
+        "scripts_per_second": scripts / seconds if seconds else 0.0,
+        "bytes_per_second": size / seconds if seconds else 0.0,
+    }
+
+
+def measure(paths: list[Path], output_path: Path, repeat: int = 3) -> dict:
+    """measures parse, translate and write throughput over paths
+
+    Each phase is timed on its own and the fastest of `repeat` runs is
+    reported.  Parse covers `parse_scripts`, translate covers rendering
+    every `Script` with `LuaTranslator`, and write covers
+    `write_scripts_to_files` into output_path.
+    """
+    sources = [path.read_text(encoding="utf-8") for path in paths]
+    input_bytes = sum(len(source.encode("utf-8")) for source in sources)
+    best: dict[str, float] = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parsed = [parse_scripts(source, LuaTranslator()) for source in sources]
+        parse_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        output_bytes = sum(
+            len(script.text.encode("utf-8")) for scripts in parsed for script in scripts
+        )
+        translate_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for scripts in parsed:
+            write_scripts_to_files(scripts, output_path)
+        write_seconds = time.perf_counter() - start
+
+        for name, seconds in (
+            ("parse", parse_seconds),
+            ("translate", translate_seconds),
+            ("write", write_seconds),
+        ):
+            best[name] = min(best.get(name, seconds), seconds)
+
+    scripts = sum(len(scripts) for scripts in parsed)
+    return {
+        "files": len(paths),
+        "scripts": scripts,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "parse": phase(best["parse"], scripts, input_bytes),
+        "translate": phase(best["translate"], scripts, output_bytes),
+        "write": phase(best["write"], scripts, output_bytes),
+    }
+
+
+def measure_translate_micro(number: int = 5000, repeat: int = 5) -> dict:
+    """measures the per-script translation cost before and after compilation
+
+    "after" renders a fresh `Script`'s `text`, the path builds write.
+    """
+    data = yaml.safe_load(SAMPLE)["prep"]
+    legacy, compiled = LegacyLuaTranslator(), LuaTranslator()
+    assert legacy_render(data, legacy) == Script("prep", data, compiled).text
+
+    results = {}
+    for label, function in (
+        ("before", lambda: legacy_render(data, legacy)),
+        ("after", lambda: Script("prep", data, compiled).text),
+    ):
+        best = min(timeit.repeat(function, number=number, repeat=repeat))
+        results[f"{label}_us_per_script"] = best / number * 1e6
+    return results
+
+
+def interpreter_env() -> dict[str, str]:
+    """returns the environment of measured interpreters, with bytecode caching"""
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def measure_startup(args=("-c", "import wrangler"), runs: int = 5) -> float:
+    """returns the fastest wall time, in seconds, of a fresh interpreter
+    running args, after one run to warm the bytecode cache"""
+    command, env = [sys.executable, *args], interpreter_env()
+    best = float("inf")
+    for run in range(runs + 1):
+        start = time.perf_counter()
+        subprocess.run(command, capture_output=True, cwd=Path(__file__).parent, env=env)
+        if run:
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_import(args=("-c", "import wrangler"), runs: int = 5) -> dict:
+    """measures the imports of a fresh interpreter running args
+
+    Runs `python -X importtime` once to warm the bytecode cache, then
+    keeps the fastest cumulative time of each module over runs.  Returns
+    `{module: microseconds}` for every module imported, and the exit
+    status and standard error of the last run.
+    """
+    env = interpreter_env()
+    command = [sys.executable, "-X", "importtime", *args]
+    cumulative: dict[str, int] = {}
+    for run in range(runs + 1):
+        process = subprocess.run(
+            command, capture_output=True, text=True, cwd=Path(__file__).parent, env=env
+        )
+        if not run:
+            continue
+        for line in process.stderr.splitlines():
+            fields = line.removeprefix("import time:").split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name, micros = fields[2].strip(), int(fields[1])
+            cumulative[name] = min(micros, cumulative.get(name, micros))
+    return {
+        "cumulative_us": cumulative,
+        "returncode": process.returncode,
+        "stderr": process.stderr,
+    }
+
+
+def commit() -> str:
+    """returns the current git commit, if there is one"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: dict, baseline: dict) -> list[str]:
+    """returns one line per phase comparing throughput against a baseline"""
+    lines = []
+    for name in ("parse", "translate", "write"):
+        now = current["suite"][name]["scripts_per_second"]
+        before = baseline["suite"][name]["scripts_per_second"]
+        change = (now / before - 1) * 100 if before else 0.0
+        lines.append(
+            f"{name:>9}: {before:12.0f} -> {now:12.0f} scripts/s ({change:+.1f}%)"
+        )
+    if "import_us" in baseline:
+        lines.append(
+            f"{'import':>9}: {baseline['import_us']:12.0f} -> "
+            f"{current['import_us']:12.0f} us"
+        )
+    return lines
+
+
+def main():
+    """runs the benchmark suite"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--scripts", type=int, default=50, help="scripts per file")
+    parser.add_argument("--modules", type=int, default=8, help="modules per script")
+    parser.add_argument(
+        "--modulepaths", type=int, default=2, help="module paths per script"
+    )
+    parser.add_argument("--anchors", type=int, default=2, help="templates per file")
+    parser.add_argument(
+        "--merge-density",
+        type=float,
+        default=0.5,
+        help="probability a content item merges a template",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--number", type=int, default=5000, help="micro iterations")
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    parser.add_argument("--compare", type=Path, help="baseline results to compare")
+    args = parser.parse_args()
+
+    params = {
+        "files": args.files,
+        "scripts": args.scripts,
+        "modules": args.modules,
+        "modulepaths": args.modulepaths,
+        "anchors": args.anchors,
+        "merge_density": args.merge_density,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as temp:
+        paths = generate_stack(Path(temp) / "stack", **params)
+        (Path(temp) / "out").mkdir()
+        suite = measure(paths, Path(temp) / "out", args.repeat)
+
+    results = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "libyaml": bool(getattr(yaml, "__with_libyaml__", False)),
+        "params": params,
+        "suite": suite,
+        "translate_micro": measure_translate_micro(args.number, args.repeat),
+        "import_us": measure_import(runs=args.repeat)["cumulative_us"]["wrangler"],
+    }
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.json is not None:
+        args.json.write_text(text + "\n", encoding="utf-8")
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        print("\n".join(compare(results, baseline)))
+
+
+if __name__ == "__main__":
+    main()
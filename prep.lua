@@ -0,0 +1,20 @@
+help([[Load environment to run prep job on WCOSS2]])
+load(pathJoin("PrgEnv-intel", "os.getenv(PrgEnv_intel_ver)"))
+load(pathJoin("hdf5"))
+load(pathJoin("python", "3.8.5"))
+load(pathJoin("netcdf", "os.getenv(netcdf_ver)"))
+load(pathJoin("crtm", "os.getenv(crtm_ver)"))
+prepend_path("MODULEPATH", pathJoin("/extra1/lfs/h2/emc/global/save/emc.global/git/prepobs/module"))
+load(pathJoin("extra1", "os.getenv(prepobs_ver)"))
+load(pathJoin("extra1", "os.getenv(prepobs_ver)"))
+load(pathJoin("extra1", "os.getenv(prepobs_ver)"))
+setenv("a", "extra1")
+setenv("b", "extra1")
+prepend_path("MODULEPATH", pathJoin("/extra2/lfs/h2/emc/global/save/emc.global/git/prepobs/module"))
+load(pathJoin("extra2", "os.getenv(prepobs_ver)"))
+load(pathJoin("extra2", "os.getenv(prepobs_ver)"))
+load(pathJoin("extra2", "os.getenv(prepobs_ver)"))
+setenv("a", "extra2")
+setenv("b", "extra2")
+load(pathJoin("prod_util", "os.getenv(prod_util_ver)"))
+whatis("prep run environment")
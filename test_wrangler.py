@@ -1,13 +1,68 @@
 """tests"""
+
 import json
+import logging
 import os
+import threading
+import time
 from pathlib import Path
+import pytest
 import yaml
 
-from wrangler import LuaTranslator, Script, write_scripts_to_files
+from bench_wrangler import generate_stack, measure, measure_import, measure_startup
+from wrangler import (
+    CLI,
+    BuildOptions,
+    Client,
+    DataCache,
+    FragmentLibrary,
+    LinkingWriter,
+    LuaTranslator,
+    Manifest,
+    ModuleIndex,
+    OutputWriter,
+    Renderer,
+    ResolutionContext,
+    Script,
+    Server,
+    TARGETS,
+    Stats,
+    Translator,
+    Watcher,
+    build,
+    check_modules,
+    compile_template,
+    duplicate_scripts,
+    extract_bundle,
+    forward,
+    get_loader,
+    merge_shards,
+    parse_scripts,
+    rebuild,
+    render,
+    stream_scripts,
+    unresolved_variables,
+    write_scripts_to_files,
+)
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))  # This is your Project Root
 
+# the time `import wrangler` adds to interpreter start up may be this many
+# times that of a bare `python -c pass` measured in the same run
+IMPORT_BUDGET = float(os.environ.get("WRANGLER_IMPORT_BUDGET", "8"))
+
+LAZY_IMPORTS = (
+    "argparse",
+    "asyncio",
+    "concurrent.futures",
+    "json",
+    "socket",
+    "sqlite3",
+    "tarfile",
+    "yaml",
+    "zipfile",
+)
+
 SAMPLE_1 = """
 test_1_eobsss:
     help: Load environment to run eobs job on WCOSS2
@@ -382,6 +437,1099 @@ def test_run_sample_3():
         assert script.content == expected
 
 
+def write_samples(root: Path) -> list[Path]:
+    """writes the samples to yaml files under root"""
+    paths = []
+    for idx, sample in enumerate([SAMPLE_1, SAMPLE_2, SAMPLE_3]):
+        path = root / f"nested{idx}" / f"{idx}.yaml"
+        path.parent.mkdir(parents=True)
+        path.write_text(sample, encoding="utf-8")
+        paths.append(path)
+    return paths
+
+
+def test_get_queue_expands_directories_and_globs(tmp_path):
+    """Directories and glob patterns expand to sorted yaml files"""
+    paths = write_samples(tmp_path)
+    (tmp_path / "notes.txt").write_text("ignored", encoding="utf-8")
+
+    assert list(CLI().get_queue([tmp_path])) == paths
+    assert list(CLI().get_queue([tmp_path / "*" / "[12].yaml", paths[1]])) == paths[1:]
+
+
+def test_get_queue_rejects_patterns_without_matches(tmp_path):
+    """A directory or glob pattern without yaml files is an error"""
+    for _path in (tmp_path, tmp_path / "*.yaml"):
+        with pytest.raises(SystemExit) as error:
+            list(CLI().get_queue([_path]))
+        assert error.value.code == 2
+
+
+def test_build_parallel_matches_serial(tmp_path):
+    """Parallel builds write the same output and order errors by input, and
+    the last input defining a script wins"""
+    paths = write_samples(tmp_path / "in")
+    broken = tmp_path / "in" / "broken.yaml"
+    broken.write_text("a: [", encoding="utf-8")
+    duplicate = tmp_path / "in" / "duplicate.yaml"
+    duplicate.write_text("test4:\n    whatis: duplicate\n", encoding="utf-8")
+    inputs = [
+        paths[0],
+        broken,
+        paths[1],
+        tmp_path / "missing.yaml",
+        paths[2],
+        duplicate,
+    ]
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+
+    serial = build(inputs, (tmp_path / "serial"), jobs=1)
+    parallel = build(inputs, (tmp_path / "parallel"), jobs=3)
+
+    for results in (serial, parallel):
+        assert [result.path for result in results] == inputs
+        assert [r.ok for r in results] == [True, False, True, False, True, True]
+    assert [r.error for r in serial] == [r.error for r in parallel]
+    assert duplicate_scripts(serial) == {"test4": [str(paths[1]), str(duplicate)]}
+
+    written = sorted(path.name for path in (tmp_path / "serial").iterdir())
+    assert written == [
+        "prep.lua",
+        "test4.lua",
+        "test_1_eobsss.lua",
+        "test_1_preppp.lua",
+    ]
+    for name in written:
+        assert (tmp_path / "serial" / name).read_text() == (
+            tmp_path / "parallel" / name
+        ).read_text()
+    assert "duplicate" in (tmp_path / "parallel" / "test4.lua").read_text()
+
+
+def test_incremental_build_skips_and_prunes(tmp_path, monkeypatch):
+    """Incremental builds skip unchanged inputs and prune stale outputs"""
+    monkeypatch.delenv("hdf5_ver", raising=False)
+    paths = write_samples(tmp_path / "in")
+    output = tmp_path / "out"
+    output.mkdir()
+
+    first = build(paths, output, incremental=True)
+    assert not any(result.skipped for result in first)
+    assert all(result.skipped for result in build(paths, output, incremental=True))
+
+    monkeypatch.setenv("hdf5_ver", "8")
+    rebuilt = build(paths, output, incremental=True)
+    assert [result.skipped for result in rebuilt] == [False, False, True]
+    assert 'load(pathJoin("hdf5", "8"))' in (output / "test4.lua").read_text()
+
+    paths[0].write_text(SAMPLE_1.split("test_1_preppp")[0], encoding="utf-8")
+    paths[2].unlink()
+    build(paths[:2], output, incremental=True)
+    assert sorted(path.name for path in output.glob("*.lua")) == [
+        "test4.lua",
+        "test_1_eobsss.lua",
+    ]
+
+    (output / "test4.lua").unlink()
+    restored = build(paths[:2], output, incremental=True)
+    assert [result.skipped for result in restored] == [True, False]
+    assert (output / "test4.lua").exists()
+    rebuilt = build(paths[:2], output, incremental=True, loader="python")
+    assert not any(result.skipped for result in rebuilt)
+
+
+def test_incremental_build_keeps_moved_scripts(tmp_path):
+    """A script that moves to a later input is not removed as stale"""
+    first, second = tmp_path / "a.yaml", tmp_path / "b.yaml"
+    first.write_text("s1:\n    whatis: a\ns2:\n    whatis: a\n", encoding="utf-8")
+    second.write_text("s3:\n    whatis: b\n", encoding="utf-8")
+    output = tmp_path / "out"
+    output.mkdir()
+    build([first, second], output, incremental=True)
+
+    first.write_text("s2:\n    whatis: a\n", encoding="utf-8")
+    second.write_text("s1:\n    whatis: b\ns3:\n    whatis: b\n", encoding="utf-8")
+    build([first, second], output, incremental=True)
+    assert sorted(path.name for path in output.glob("*.lua")) == [
+        "s1.lua",
+        "s2.lua",
+        "s3.lua",
+    ]
+
+
+def test_data_cache_skips_parsing(tmp_path, monkeypatch):
+    """Cached data renders like a fresh parse under a new context, and the
+    cache evicts its least recently used entries beyond its limit"""
+    paths = write_samples(tmp_path / "in")
+    dated = tmp_path / "in" / "dated.yaml"
+    dated.write_text("dated:\n    whatis: 2021-01-01\n", encoding="utf-8")
+    paths.append(dated)
+    for name in ("cached", "fresh"):
+        (tmp_path / name).mkdir()
+    cache = DataCache(tmp_path / "cache")
+    build(paths, tmp_path / "cached", data_cache=cache)
+    assert (cache.hits, cache.misses) == (0, 4)
+    assert len(list((tmp_path / "cache").iterdir())) == 3
+
+    context = ResolutionContext({"hdf5_ver": "8"})
+    monkeypatch.setattr("wrangler.parse_scripts", None)
+    for io_threads in (0, 2):
+        build(
+            paths,
+            tmp_path / "cached",
+            context=context,
+            io_threads=io_threads,
+            data_cache=cache,
+        )
+    assert (cache.hits, cache.misses) == (6, 6)
+    monkeypatch.undo()
+    build(paths, tmp_path / "fresh", context=context)
+    for path in (tmp_path / "fresh").iterdir():
+        assert (tmp_path / "cached" / path.name).read_text() == path.read_text()
+
+    entries = sorted((tmp_path / "cache").iterdir())
+    os.utime(entries[0], ns=(0, 0))
+    cache.limit = sum(entry.stat().st_size for entry in entries[1:])
+    cache.prune()
+    assert sorted((tmp_path / "cache").iterdir()) == sorted(entries[1:])
+
+
+def test_sharded_builds_merge(tmp_path):
+    """Shards split the scripts of even a single file between them, and the
+    merge step checks that every script was produced exactly once"""
+    paths = write_samples(tmp_path / "in")
+    big = tmp_path / "in" / "big.yaml"
+    big.write_text(
+        "".join(f"big{idx}:\n    whatis: big\n" for idx in range(60)), encoding="utf-8"
+    )
+    duplicate = tmp_path / "in" / "duplicate.yaml"
+    duplicate.write_text("test4:\n    whatis: duplicate\n", encoding="utf-8")
+    paths += [big, duplicate]
+    for name in ("whole", "out"):
+        (tmp_path / name).mkdir()
+    output = tmp_path / "out"
+    whole = build(paths, tmp_path / "whole")
+
+    sizes = []
+    for index in (1, 2, 3):
+        results = build(paths, output, jobs=index, shard=(index, 3))
+        assert [result.ok for result in results] == [True] * 5
+        sizes.append(sum(len(result.scripts) for result in results))
+    assert sum(sizes) == sum(len(result.scripts) for result in whole)
+    assert min(sizes) > 10
+
+    manifests = [
+        json.loads(path.read_text()) for path in output.glob(".wrangler-shard-*")
+    ]
+    assert merge_shards(manifests) == [
+        f"script test4 is defined by several inputs: {duplicate}, {paths[1]}"
+    ]
+    problems = merge_shards(manifests[1:])
+    assert problems[0] == f"shard {manifests[0]['shard']}/3 has 0 manifests"
+    assert any("was produced by shards: none" in problem for problem in problems)
+
+
+def test_interpolation():
+    """Module, modulepath and environment strings interpolate any number of
+    embedded references, with defaults, and modules split at their last /"""
+    translator = LuaTranslator(ResolutionContext({"v": "1", "root": "/apps"}))
+    assert translator.modules(
+        ["x/${v}-${w}", "a/b/c", "y/${w:-9}", "z/${q:-a/b}", "plain"]
+    ) == [
+        'load(pathJoin("x", "1-os.getenv(w)"))\n',
+        'load(pathJoin("a/b", "c"))\n',
+        'load(pathJoin("y", "9"))\n',
+        'load(pathJoin("z", "a/b"))\n',
+        'load(pathJoin("plain"))\n',
+    ]
+    assert translator.module_paths(["${root}/modules", "${w}/modules", "None"]) == [
+        'prepend_path("MODULEPATH", pathJoin("/apps/modules"))\n',
+        'prepend_path("MODULEPATH", pathJoin("os.getenv(w)/modules"))\n',
+    ]
+    assert translator.environment([{"PATH": "${root}/${v}/bin"}]) == [
+        'setenv("PATH", "/apps/1/bin")\n'
+    ]
+    assert translator.resolved == {"v": "1", "w": None, "q": None, "root": "/apps"}
+    assert translator.references == {
+        "load": {"a/b/c", "plain", "y/9", "z/a/b"},
+        "modulepath": {"/apps/modules"},
+    }
+    assert compile_template("x/${v}-${w:-2}") == ("x/", ("v", None), "-", ("w", "2"))
+
+
+def merge_heavy_sample(anchors: int = 5, scripts: int = 20) -> str:
+    """returns yaml with many anchors merged into every script"""
+    lines = []
+    for idx in range(anchors):
+        lines += [
+            f"^frag{idx}: &frag{idx}",
+            f"  modulepaths: [/opt/frag{idx}]",
+            f'  modules: ["frag{idx}/${{frag{idx}_ver}}", plain{idx}]',
+            f"  environment: [{{FRAG{idx}: on}}]",
+        ]
+    for idx in range(scripts):
+        merges = ", ".join(f"*frag{(idx + step) % anchors}" for step in range(3))
+        lines += [
+            f"script{idx}:",
+            f"  help: help {idx}",
+            f"  whatis: whatis {idx}",
+            "  content:",
+            f"    - <<: [{merges}]",
+            f"      modules: [own{idx}/1.0]",
+            f"    - <<: *frag{idx % anchors}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.skipif(
+    getattr(yaml, "CSafeLoader", None) is None, reason="libyaml is not available"
+)
+@pytest.mark.parametrize(
+    "sample",
+    [SAMPLE_1, SAMPLE_2, SAMPLE_3, merge_heavy_sample()],
+    ids=["sample_1", "sample_2", "sample_3", "merge_heavy"],
+)
+def test_loader_parity(sample, tmp_path):
+    """Scripts are byte-identical between the libyaml and Python loaders"""
+    assert get_loader("auto") is yaml.CSafeLoader
+    outputs = {}
+    for loader in ("c", "python"):
+        scripts = parse_scripts(sample, LuaTranslator(), loader)
+        (tmp_path / loader).mkdir()
+        write_scripts_to_files(scripts, tmp_path / loader)
+        outputs[loader] = [(repr(script), str(script)) for script in scripts]
+        outputs[loader] += [
+            (path.name, path.read_bytes())
+            for path in sorted((tmp_path / loader).iterdir())
+        ]
+    assert outputs["c"] == outputs["python"]
+
+
+def test_script_renders_once_until_invalidated():
+    """Script caches its translation until data or translator changes"""
+    calls = []
+
+    class CountingTranslator(LuaTranslator):
+        """counts translator calls"""
+
+        def __call__(self, key, value):
+            calls.append(key)
+            return super().__call__(key, value)
+
+    data = yaml.safe_load(SAMPLE_1)["test_1_eobsss"]
+    script = Script("test_1_eobsss", data, CountingTranslator())
+    assert not hasattr(script, "__dict__")
+
+    first = (str(script), script.help, script.content, script.whatis)
+    assert (str(script), script.help, script.content, script.whatis) == first
+    assert len(calls) == 3
+
+    script.data = {"help": "changed"}
+    assert script.help == ["help([[changed]])\n"]
+    assert script.content == []
+    assert len(calls) == 5
+
+    script.data["whatis"] = "mutated"
+    assert script.whatis == []
+    script.invalidate()
+    assert script.whatis == ['whatis("mutated")\n']
+    assert script.text == 'help([[changed]])\nwhatis("mutated")\n'
+    script.data = {"whatis": "assigned"}
+    assert script.text == 'whatis("assigned")\n'
+
+
+@pytest.mark.parametrize(
+    "sample",
+    [SAMPLE_1, SAMPLE_2, SAMPLE_3, merge_heavy_sample()],
+    ids=["sample_1", "sample_2", "sample_3", "merge_heavy"],
+)
+def test_render_matches_script_lines(sample):
+    """The compiled render path matches Script output exactly"""
+    translator = LuaTranslator()
+    for script in parse_scripts(sample, translator):
+        assert translator.render(script.data) == "".join(script.lines)
+        assert script.text == "".join(script.lines)
+
+
+@pytest.mark.parametrize("loader", ["auto", "python"])
+def test_stream_scripts_matches_parse_scripts(loader, tmp_path, caplog):
+    """Streaming yields the same scripts, including across documents and
+    top-level merges, and builds the last definition of a duplicate script"""
+    merged = """
+^base: &base
+  merged_a:
+    whatis: a
+^more: &more
+  merged_b:
+    content: [{modules: [b/1]}]
+<<: [*base, *more]
+after:
+    whatis: after
+"""
+    samples = [SAMPLE_1, SAMPLE_2, SAMPLE_3, merge_heavy_sample(), merged]
+    expected = [
+        (repr(script), script.text)
+        for sample in samples
+        for script in parse_scripts(sample, LuaTranslator(), loader)
+    ]
+
+    stream = "\n---\n".join(samples) + "\n---\n"
+    streamed = stream_scripts(stream, LuaTranslator(), loader)
+    assert [(repr(script), script.text) for script in streamed] == expected
+
+    path = tmp_path / "stream.yaml"
+    path.write_text(stream, encoding="utf-8")
+    (tmp_path / "out").mkdir()
+    results = build([path], tmp_path / "out", loader=loader, stream=True)
+    assert results[0].scripts == [json.loads(line)["name"] for line, _ in expected]
+
+    with pytest.raises(AttributeError):
+        list(stream_scripts("- not a mapping\n", LuaTranslator(), loader))
+
+    duplicated = tmp_path / "duplicated.yaml"
+    duplicated.write_text(
+        "a: {whatis: one}\nb: {}\na: {whatis: two}\n"
+        "<<: {a: {whatis: merged}, c: {whatis: merged}}\n",
+        encoding="utf-8",
+    )
+    overridden = tmp_path / "overridden.yaml"
+    overridden.write_text(merged + "merged_a: {whatis: explicit}\n", encoding="utf-8")
+    for stream in (False, True):
+        output = tmp_path / f"duplicated-{stream}"
+        output.mkdir()
+        results = build([duplicated, overridden], output, loader=loader, stream=stream)
+        assert [sorted(result.scripts) for result in results] == [
+            ["a", "b", "c"],
+            ["after", "merged_a", "merged_b"],
+        ]
+        assert 'whatis("two")' in (output / "a.lua").read_text()
+        assert 'whatis("merged")' in (output / "c.lua").read_text()
+        assert 'whatis("explicit")' in (output / "merged_a.lua").read_text()
+    assert "script 'a' is defined more than once" in caplog.text
+
+
+@pytest.mark.parametrize("output_format", ["tar", "zip", "sqlite"])
+def test_bundle_round_trip(output_format, tmp_path):
+    """Bundles extract to the same tree as the files output format"""
+    paths = write_samples(tmp_path / "in")
+    (tmp_path / "files").mkdir()
+    build(paths, tmp_path / "files")
+    bundle = tmp_path / f"modules.{output_format}"
+    results = build(paths, bundle, jobs=2, output_format=output_format)
+    assert all(result.ok and not result.outputs for result in results)
+
+    assert extract_bundle(bundle, tmp_path / "extracted") == 4
+    for path in (tmp_path / "files").iterdir():
+        assert (tmp_path / "extracted" / path.name).read_text() == path.read_text()
+
+    class Unwritable(OutputWriter):
+        pass
+
+    with pytest.raises(TypeError, match="write"):
+        Unwritable()
+
+
+def test_resolution_context_from_versions_and_env_snapshot(tmp_path, monkeypatch):
+    """Versions files and env snapshots resolve variables without os.getenv"""
+    monkeypatch.setenv("hdf5_ver", "from-environment")
+    versions = tmp_path / "run.ver"
+    versions.write_text(
+        "# versions\nexport hdf5_ver=1.10.6\nexport python_ver=3.8.6  # pinned\n"
+        'netcdf_ver="${hdf5_ver}-nc"\n',
+        encoding="utf-8",
+    )
+    snapshot = tmp_path / "snapshot.env"
+    snapshot.write_text("crtm_ver=2.4.0\nhdf5_ver=snapshot\n", encoding="utf-8")
+    context = ResolutionContext.from_sources([versions], [snapshot], False)
+
+    script = parse_scripts(SAMPLE_1, LuaTranslator(context))[1]
+    assert script.content == [
+        'load(pathJoin("hdf5", "1.10.6"))\n',
+        'load(pathJoin("python", "3.8.6"))\n',
+        'load(pathJoin("netcdf", "1.10.6-nc"))\n',
+        'load(pathJoin("crtm", "2.4.0"))\n',
+    ]
+    assert context.unresolved == set()
+
+    paths = write_samples(tmp_path / "in")
+    (tmp_path / "out").mkdir()
+    results = build(paths, tmp_path / "out", context=context)
+    assert sorted(context.unresolved) == sorted(unresolved_variables(results))
+    assert sorted(context.unresolved) == [
+        "PrgEnv_intel_ver",
+        "cray_mpich_ver",
+        "cray_pals_ver",
+        "prepobs_ver",
+        "prod_util_ver",
+    ]
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watcher_rebuilds_only_changed_file(inotify, tmp_path):
+    """Watch mode reports changed inputs and rebuilds just their scripts"""
+    paths = write_samples(tmp_path / "in")
+    output = tmp_path / "out"
+    output.mkdir()
+    results = build(paths, output)
+    manifest = Manifest(output)
+    for result in results:
+        manifest.update(result)
+
+    with Watcher(paths, interval=0.01, inotify=inotify) as watcher:
+        assert watcher.changes(timeout=0.05) == []
+        paths[0].write_text(SAMPLE_1.split("test_1_preppp")[0], encoding="utf-8")
+        changed = watcher.changes(timeout=5)
+    assert changed == [paths[0]]
+
+    before = (output / "test4.lua").stat().st_mtime_ns
+    result = rebuild(changed[0], BuildOptions(output), manifest)
+    assert result.scripts == ["test_1_eobsss"]
+    assert not (output / "test_1_preppp.lua").exists()
+    assert (output / "test4.lua").stat().st_mtime_ns == before
+
+
+def test_watcher_queue_overflow_changes_every_input(tmp_path):
+    """An inotify queue overflow reports every input as changed"""
+    paths = write_samples(tmp_path / "in")
+    read_fd, write_fd = os.pipe()
+    with Watcher(paths, inotify=False) as watcher:
+        watcher.fd = read_fd
+        os.write(write_fd, Watcher.EVENT.pack(-1, Watcher.IN_Q_OVERFLOW, 0, 0))
+        os.write(write_fd, Watcher.EVENT.pack(99, Watcher.IN_CLOSE_WRITE, 0, 0))
+        assert watcher.changes(timeout=1) == paths
+    os.close(write_fd)
+
+
+def test_benchmark_generator_and_measure(tmp_path):
+    """The synthetic stack parses and every phase is measured"""
+    paths = generate_stack(tmp_path / "stack", files=2, scripts=3, anchors=2)
+    (tmp_path / "out").mkdir()
+    results = measure(paths, tmp_path / "out", repeat=1)
+    assert (results["files"], results["scripts"]) == (2, 6)
+    assert len(list((tmp_path / "out").iterdir())) == 6
+    for name in ("parse", "translate", "write"):
+        assert results[name]["seconds"] > 0
+
+
+@pytest.mark.parametrize("jobs,stream", [(1, False), (1, True), (2, False)])
+def test_build_stats(jobs, stream, tmp_path):
+    """Stats record every phase, throughput and the slowest files"""
+    paths = write_samples(tmp_path / "in")
+    (tmp_path / "out").mkdir()
+    stats = Stats()
+    results = build(paths, tmp_path / "out", jobs=jobs, stream=stream, stats=stats)
+    assert all(result.stats is None for result in results)
+
+    report = stats.report(wall=1.0, cpu=1.0, slowest=2)
+    assert (report["files"], report["scripts"]) == (3, 4)
+    assert report["bytes"] == sum(
+        path.stat().st_size for path in (tmp_path / "out").glob("*.lua")
+    )
+    assert all(phase["wall_seconds"] > 0 for phase in report["phases"].values())
+    assert len(report["slowest_files"]) == 2
+    slowest = [entry["seconds"] for entry in report["slowest_files"]]
+    assert slowest == sorted(slowest, reverse=True)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_pipeline_matches_serial(stream, tmp_path):
+    """Pipelined builds match serial output, ordering, errors and stats"""
+    paths = write_samples(tmp_path / "in")
+    broken = tmp_path / "in" / "broken.yaml"
+    broken.write_text("a: [", encoding="utf-8")
+    bad_script = tmp_path / "in" / "bad_script.yaml"
+    bad_script.write_text("good: {help: ok}\nbad: {content: [1]}\n", encoding="utf-8")
+    inputs = [paths[0], broken, paths[1], bad_script, tmp_path / "nope", paths[2]]
+
+    outputs = {}
+    for io_threads in (0, 3):
+        output = tmp_path / f"out{io_threads}"
+        output.mkdir()
+        stats = Stats()
+        results = build(
+            inputs, output, stream=stream, stats=stats, io_threads=io_threads
+        )
+        report = stats.report(1.0, 1.0)
+        outputs[io_threads] = (
+            [(r.path, r.scripts, r.error, r.digest) for r in results],
+            {path.name: path.read_text() for path in output.iterdir()},
+            report["scripts"],
+            report["bytes"],
+            len(report["slowest_files"]),
+        )
+    assert outputs[0] == outputs[3]
+    assert [error is None for _, _, error, _ in outputs[3][0]] == [
+        True,
+        False,
+        True,
+        False,
+        False,
+        True,
+    ]
+
+
+@pytest.mark.parametrize("io_threads", [0, 2])
+def test_pipeline_raises_fatal_errors(io_threads, tmp_path):
+    """Errors that abort a serial build are raised by the pipeline too"""
+    deep = tmp_path / "deep.yaml"
+    deep.write_text("a: " + "[" * 1000 + "]" * 1000 + "\n", encoding="utf-8")
+    with pytest.raises(RecursionError):
+        build([deep], tmp_path, loader="python", io_threads=io_threads)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_shared_anchor_fragments_translate_once(streaming):
+    """A preamble merged into many scripts is translated once"""
+    calls = []
+
+    class CountingTranslator(LuaTranslator):
+        """counts module translations"""
+
+        def modules(self, values):
+            calls.append(values)
+            return super().modules(values)
+
+    sample = '^pre: &pre\n  modules: ["a/${a_ver}", b/1, c]\n  modulepaths: [/opt]\n'
+    sample += "".join(
+        f"s{idx}:\n  content:\n    - <<: *pre\n    - modules: [own{idx}]\n"
+        for idx in range(500)
+    )
+    translator = CountingTranslator(ResolutionContext({"a_ver": "1"}))
+    if streaming:
+        texts = [script.text for script in stream_scripts(sample, translator)]
+    else:
+        texts = [script.text for script in parse_scripts(sample, translator)]
+
+    assert len(calls) == 501
+    expected = [
+        LuaTranslator(ResolutionContext({"a_ver": "1"})).render(data)
+        for name, data in yaml.safe_load(sample).items()
+        if "^" not in name
+    ]
+    assert texts == expected
+    assert texts[0].startswith('load(pathJoin("a", "1"))\n')
+
+
+def test_render_in_memory(tmp_path, monkeypatch):
+    """The library API renders text, dicts and batches without touching disk"""
+    monkeypatch.chdir(tmp_path)
+    expected = {}
+    for sample in (SAMPLE_1, SAMPLE_2, SAMPLE_3):
+        for script in parse_scripts(sample, LuaTranslator()):
+            expected[script.name] = script.text
+
+    result = render([SAMPLE_1, yaml.safe_load(SAMPLE_2), SAMPLE_3.encode()])
+    assert result.ok and result.scripts == expected
+    assert render("\n---\n".join([SAMPLE_1, SAMPLE_2])).scripts.keys() == {
+        "test_1_eobsss",
+        "test_1_preppp",
+        "test4",
+    }
+
+    batch = Renderer().render_batch(
+        ["a: [", "- 1", {"ok": {"help": "h"}, "bad": {"content": [1]}}, SAMPLE_3]
+    )
+    assert [list(item.scripts) for item in batch] == [[], [], ["ok"], ["prep"]]
+    assert [[repr(error) for error in item.errors] for item in batch][:3] == [
+        [repr(batch[0].errors[0])],
+        [
+            '{"source": 0, "script": null, "message": '
+            '"AttributeError: yaml documents must be mappings of scripts"}'
+        ],
+        [
+            '{"source": 0, "script": "bad", "message": '
+            "\"AttributeError: 'int' object has no attribute 'items'\"}"
+        ],
+    ]
+    assert batch[0].errors[0].message.startswith("YAMLError")
+    assert batch[3].ok
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_server_requests(tmp_path, caplog):
+    """A server renders and builds on request and keeps parsed inputs warm"""
+    paths = write_samples(tmp_path / "inputs")
+    expected = tmp_path / "expected"
+    expected.mkdir()
+    context = ResolutionContext({"cray_mpich_ver": "8.1.9"})
+    build(paths, expected, context=context)
+
+    server = Server(tmp_path / "wrangler.sock", context)
+    thread = threading.Thread(target=server.run)
+    thread.start()
+    assert server.ready.wait(5)
+    try:
+        with Client(server.socket_path, timeout=10) as client:
+            assert client.request("ping") == {
+                "ok": True,
+                "id": 1,
+                "elapsed_ms": pytest.approx(0, abs=1000),
+            }
+            for _ in range(2):
+                response = client.request(
+                    "build",
+                    paths=[str(path) for path in paths],
+                    output_path=str(tmp_path / "out"),
+                    stats=True,
+                )
+                assert response["ok"] and response["stats"]["files"] == 3
+                assert [result["path"] for result in response["results"]] == [
+                    str(path) for path in paths
+                ]
+            status = client.request("status")
+            assert (status["misses"], status["hits"], status["cached"]) == (3, 3, 3)
+
+            response = client.request(
+                "render", sources=[SAMPLE_3, "a: ["], paths=[str(paths[0])]
+            )
+            assert not response["ok"]
+            assert [error["source"] for error in response["errors"]] == [1]
+            assert set(response["scripts"]) == {
+                "prep",
+                "test_1_eobsss",
+                "test_1_preppp",
+            }
+            assert client.request("status")["hits"] == 4
+
+            response = client.request("nope")
+            assert not response["ok"] and "invalid request" in response["error"]
+
+            def fail(request):
+                raise RuntimeError("boom")
+
+            server.status = fail
+            response = client.request("status")
+            assert response == {
+                "ok": False,
+                "error": "RuntimeError: boom",
+                "id": 8,
+                "elapsed_ms": pytest.approx(0, abs=1000),
+            }
+
+            data = {
+                "output_path": tmp_path / "forwarded",
+                "jobs": 1,
+                "incremental": False,
+                "loader": "auto",
+                "stream": True,
+                "output_format": "files",
+                "io_threads": 0,
+                "targets": ("lua",),
+                "stats": None,
+                "context": ResolutionContext({}),
+                "unresolved_report": tmp_path / "unresolved.json",
+            }
+            assert forward(server.socket_path, paths, data) == 0
+            assert json.loads(data["unresolved_report"].read_text())
+            server.build = lambda request: time.sleep(1)
+            slow = {**data, "server_timeout": 0.1}
+            assert forward(server.socket_path, paths, slow) == 2
+            client.request("shutdown")
+    finally:
+        thread.join(5)
+        if thread.is_alive():
+            with Client(server.socket_path, 5) as client:
+                client.request("shutdown")
+            thread.join(5)
+    assert not thread.is_alive() and not server.socket_path.exists()
+    assert "Exception in callback" not in caplog.text
+    for name in os.listdir(expected):
+        assert (tmp_path / "out" / name).read_text() == (expected / name).read_text()
+    assert forward(server.socket_path, paths, data) == 2
+
+
+def test_import_budget(tmp_path):
+    """Importing wrangler stays under budget and defers heavy imports to their
+    commands, so forwarding to a server never imports PyYAML"""
+    imports = measure_import()["cumulative_us"]
+    assert not set(LAZY_IMPORTS) & set(imports)
+    baseline = measure_startup(("-c", "pass"))
+    assert measure_startup() - baseline < IMPORT_BUDGET * baseline
+
+    (stack,) = write_samples(tmp_path / "in")[:1]
+    forwarded = measure_import(
+        (
+            "wrangler.py",
+            "--server",
+            str(tmp_path / "missing.sock"),
+            "--output-path",
+            str(tmp_path / "out"),
+            str(stack),
+        ),
+        runs=1,
+    )
+    assert forwarded["returncode"] == 2
+    assert "unable to reach the server" in forwarded["stderr"]
+    assert not {"yaml", "_yaml"} & set(forwarded["cumulative_us"])
+
+
+def test_check_modules(tmp_path):
+    """Loads and modulepaths are checked against a persisted module index that
+    is only relisted where directory mtimes change"""
+    modules = tmp_path / "modules"
+    for name in ("cray-mpich/8.1.9.lua", "python/3.8.6.lua", "netcdf/4.7.4", ".rc"):
+        (modules / name).parent.mkdir(parents=True, exist_ok=True)
+        (modules / name).write_text("")
+    (tmp_path / "stack.yaml").write_text(
+        f"""
+run:
+    content:
+      - modulepaths: ["{modules}", "{tmp_path / 'missing'}"]
+      - modules:
+        - cray-mpich/${{cray_mpich_ver}}
+        - cray-pals/${{cray_pals_ver}}
+        - python/3.9.1
+        - netcdf
+        - hdf5
+""",
+        encoding="utf-8",
+    )
+    (tmp_path / "out").mkdir()
+    context = ResolutionContext({"cray_mpich_ver": "8.1.9"})
+    results = build([tmp_path / "stack.yaml"], tmp_path / "out", context=context)
+    assert results[0].references == {
+        "load": ["cray-mpich/8.1.9", "hdf5", "netcdf", "python/3.9.1"],
+        "modulepath": [str(tmp_path / "missing"), str(modules)],
+    }
+
+    index = ModuleIndex(tmp_path / "index.json")
+    stack = tmp_path / "stack.yaml"
+    assert check_modules(results, index) == [
+        f"{stack}: MODULEPATH {tmp_path / 'missing'} does not exist",
+        f"{stack}: module hdf5 was not found",
+        f"{stack}: module python/3.9.1 was not found",
+    ]
+    assert index.listed == 4
+    index.save()
+
+    (modules / "python" / "3.9.1.lua").write_text("")
+    index = ModuleIndex(tmp_path / "index.json")
+    assert check_modules(results, index, [str(tmp_path / "missing")]) == [
+        f"{stack}: MODULEPATH {tmp_path / 'missing'} does not exist",
+        f"{stack}: module hdf5 was not found",
+    ]
+    assert index.listed == 1
+
+
+def test_build_targets(tmp_path):
+    """One parse writes a Lua and a Tcl subtree, and the manifest rebuilds
+    inputs when the targets change"""
+    (tmp_path / "stack.yaml").write_text(
+        """
+run:
+    whatis: the run module
+    content:
+      - modulepaths:
+          - /apps/modules
+        modules:
+          - cray-mpich/${cray_mpich_ver}
+          - hdf5/1.10.6
+        environment:
+          - CC: cc
+""",
+        encoding="utf-8",
+    )
+    (tmp_path / "out").mkdir()
+    context = ResolutionContext({})
+    results = build(
+        [tmp_path / "stack.yaml"],
+        tmp_path / "out",
+        context=context,
+        incremental=True,
+        targets=("lua", "tcl"),
+    )
+    assert results[0].ok
+    written = (tmp_path / "out").rglob("run*")
+    assert sorted(str(p.relative_to(tmp_path / "out")) for p in written) == [
+        "lua/run.lua",
+        "tcl/run",
+    ]
+    assert (tmp_path / "out" / "tcl" / "run").read_text() == (
+        "#%Module1.0\n"
+        "prepend-path MODULEPATH {/apps/modules}\n"
+        "module load cray-mpich/$env(cray_mpich_ver)\n"
+        "module load hdf5/1.10.6\n"
+        "setenv CC {cc}\n"
+        "module-whatis {the run module}\n"
+    )
+
+    results = build(
+        [tmp_path / "stack.yaml"], tmp_path / "out", context=context, incremental=True
+    )
+    assert not results[0].skipped
+    assert (tmp_path / "out" / "run.lua").exists()
+    assert not (tmp_path / "out" / "tcl" / "run").exists()
+
+
+def test_library_fragments(tmp_path, caplog, monkeypatch):
+    """Included fragments render like inline content, are translated once
+    per build, and a library change rebuilds every dependent input"""
+    library_file = tmp_path / "library.yaml"
+    library_file.write_text(
+        """pre:
+    - modulepaths: ["/opt/${pre_ver}"]
+      environment:
+          - PRE: "on"
+post:
+    modules: [post/1]
+loop:
+    - include: loop
+""",
+        encoding="utf-8",
+    )
+    (tmp_path / "in").mkdir()
+    inputs = {
+        "one": "one:\n    content:\n        - include: pre\n        - modules: [a]\n",
+        "two": "two:\n    content:\n        - include: [pre, post]\n",
+        "plain": "plain:\n    content:\n        - modules: [b]\n",
+        "inline": 'inline:\n    content:\n        - modulepaths: ["/opt/${pre_ver}"]\n'
+        '          environment:\n              - PRE: "on"\n        - modules: [a]\n',
+    }
+    paths = []
+    for name, text in inputs.items():
+        paths.append(tmp_path / "in" / f"{name}.yaml")
+        paths[-1].write_text(text, encoding="utf-8")
+    library = FragmentLibrary([library_file])
+    translated = []
+    translate_fragment = Translator.translate_fragment
+
+    def counting(self, name):
+        translated.append(name)
+        return translate_fragment(self, name)
+
+    monkeypatch.setattr(Translator, "translate_fragment", counting)
+    context = ResolutionContext({"pre_ver": "2"})
+    output = tmp_path / "out"
+    output.mkdir()
+    results = build(paths, output, incremental=True, context=context, library=library)
+    assert all(result.ok for result in results)
+    assert sorted(translated) == ["post", "pre"]
+    assert (output / "one.lua").read_text() == (output / "inline.lua").read_text()
+    assert results[1].environment == {"pre_ver": "2"}
+    assert results[1].references["library"] == [str(library_file.resolve())]
+    assert results[1].references["load"] == ["post/1"]
+    assert "library" not in results[2].references
+
+    library_file.write_text(
+        library_file.read_text().replace("/opt/", "/srv/x/"), encoding="utf-8"
+    )
+    library.refresh()
+    with caplog.at_level(logging.INFO):
+        results = build(
+            paths, output, incremental=True, context=context, library=library
+        )
+    assert [result.skipped for result in results] == [False, False, True, True]
+    assert "changed, rebuilding 2 dependents" in caplog.text
+    assert "/srv/x/2" in (output / "two.lua").read_text()
+
+    paths[2].write_text("plain:\n    content:\n        - include: loop\n")
+    paths[3].write_text("inline:\n    content:\n        - include: missing\n")
+    results = build(paths[2:], output, context=context, library=library)
+    assert "includes itself" in results[0].error
+    assert "unknown fragment 'missing'" in results[1].error
+
+
+def test_optimize(tmp_path, caplog):
+    """The optimizer drops repeated loads and overridden setenvs and merges
+    adjacent MODULEPATH prepends without reordering what it keeps"""
+    translator = LuaTranslator(ResolutionContext({}))
+    lines = [
+        'setenv("A", "1")\n',
+        'prepend_path("MODULEPATH", pathJoin("/a"))\n',
+        'prepend_path("MODULEPATH", pathJoin("/b"))\n',
+        'load(pathJoin("x"))\n',
+        'setenv("A", "2")\n',
+        'setenv("B", "1")\n',
+        'setenv("B", "os.getenv(B):2")\n',
+        'setenv("C", "1")\n',
+        'load(pathJoin("x"))\n',
+        'setenv("C", "2")\n',
+        'setenv("A", "3")\n',
+        'prepend_path("MODULEPATH", pathJoin("/a"))\n',
+        'prepend_path("MODULEPATH", pathJoin("/a"))\n',
+    ]
+    assert translator.minimize(lines) == [
+        'setenv("A", "1")\n',
+        'prepend_path("MODULEPATH", "/b:/a")\n',
+        'load(pathJoin("x"))\n',
+        'setenv("B", "1")\n',
+        'setenv("B", "os.getenv(B):2")\n',
+        'setenv("C", "2")\n',
+        'setenv("A", "3")\n',
+        'prepend_path("MODULEPATH", pathJoin("/a"))\n',
+        'prepend_path("MODULEPATH", pathJoin("/a"))\n',
+    ]
+
+    paths = write_samples(tmp_path / "in")
+    for name in ("plain", "optimized"):
+        (tmp_path / name).mkdir()
+        with caplog.at_level(logging.INFO):
+            results = build(
+                paths,
+                tmp_path / name,
+                targets=("lua", "tcl"),
+                optimize=name == "optimized",
+            )
+    assert "optimizing saved 16 lines" in caplog.text
+    assert sum(result.saved[0] for result in results) == 16
+    for target in ("lua", "tcl"):
+        plain = (tmp_path / "plain" / target / "test4").with_suffix(
+            TARGETS[target].extension
+        )
+        optimized = tmp_path / "optimized" / plain.relative_to(tmp_path / "plain")
+        plain, optimized = plain.read_text().splitlines(), optimized.read_text()
+        assert len(plain) - len(optimized.splitlines()) == 4
+        loads = [
+            line
+            for line in optimized.splitlines()
+            if line.startswith(TARGETS[target].load_prefix) and "extra1" in line
+        ]
+        assert len(loads) == 1
+        assert list(dict.fromkeys(plain)) == optimized.splitlines()
+
+    translator = LuaTranslator(ResolutionContext({"prepobs_ver": "1"}))
+    translator.optimize = True
+    for script in parse_scripts(SAMPLE_2, translator):
+        assert "".join(script.lines) == script.text
+
+    class Unmergeable(Translator):
+        load = LuaTranslator.load
+        environment_lookup = LuaTranslator.environment_lookup
+
+    with pytest.raises(TypeError, match="prepend_paths"):
+        Unmergeable()
+
+
+def test_spider_cache(tmp_path):
+    """The spider cache lists every module, its help and whatis and the
+    modulepaths it adds, whether its input was built, pipelined or skipped"""
+    paths = write_samples(tmp_path / "in")
+    versioned = tmp_path / "in" / "versioned.yaml"
+    versioned.write_text(
+        """hdf5/1.10.6:
+    help: 'says "hi"'
+    whatis: [hdf5, io]
+    content:
+        - modulepaths: ["/opt/${compiler}"]
+""",
+        encoding="utf-8",
+    )
+    paths.append(versioned)
+    context = ResolutionContext({"compiler": "intel"})
+    caches = []
+    for name, io_threads, incremental in (
+        ("serial", 0, True),
+        ("pipelined", 2, False),
+        ("skipped", 0, True),
+    ):
+        cache = tmp_path / "cache" / name
+        output = tmp_path / ("serial" if name == "skipped" else name)
+        output.mkdir(exist_ok=True)
+        results = build(
+            paths,
+            output,
+            incremental=incremental,
+            context=context,
+            io_threads=io_threads,
+            spider_cache=cache,
+        )
+        assert all(result.ok for result in results)
+        assert (cache / "system.txt").read_text().strip().isdigit()
+        caches.append((cache / "spiderT.lua").read_text())
+    assert all(result.skipped for result in results)
+    assert caches[0] == caches[2]
+    assert caches[1] == caches[0].replace(
+        str((tmp_path / "serial").resolve()), str((tmp_path / "pipelined").resolve())
+    )
+
+    mpath = str((tmp_path / "serial").resolve())
+    spider = caches[0]
+    assert spider.startswith("timestampFn = {\n  false,\n}\n")
+    for name in ("test_1_eobsss", "test4", "prep"):
+        assert f'["{name}"] = {{\n      ["metaModuleT"] = {{' in spider
+        assert f'["fn"] = "{mpath}/{name}.lua",' in spider
+    assert '["hdf5/1.10.6"] = {\n          ["Version"] = "1.10.6",' in spider
+    assert '["help"] = "says \\"hi\\"",' in spider
+    assert '["pV"] = "000000001.000000010.000000006.*zfinal",' in spider
+    assert (
+        '["whatis"] = {\n            "hdf5",\n            "io",\n          },' in spider
+    )
+    edges = spider.split("mpathMapT = ")[1]
+    assert f'  ["/opt/intel"] = {{\n    ["hdf5/1.10.6"] = "{mpath}",' in edges
+
+
+def test_dedup_links_identical_scripts(tmp_path, caplog, monkeypatch):
+    """Identical scripts share one stored body through hard links, or
+    symbolic links where hard links fail, and unlinked bodies are removed"""
+    paths = write_samples(tmp_path / "in")
+    variants = tmp_path / "in" / "variants.yaml"
+    variants.write_text(
+        "".join(
+            f"job{idx}:\n    content:\n        - modules: [hdf5/1]\n"
+            for idx in range(4)
+        ),
+        encoding="utf-8",
+    )
+    paths.append(variants)
+    output = tmp_path / "out"
+    output.mkdir()
+    with caplog.at_level(logging.INFO):
+        build(paths, output, incremental=True, dedup=True)
+    assert "wrote 8 scripts as 5 distinct files" in caplog.text
+    objects = output / LinkingWriter.OBJECTS
+    assert len(list(objects.iterdir())) == 5
+    inodes = {(output / f"job{idx}.lua").stat().st_ino for idx in range(4)}
+    assert len(inodes) == 1
+    assert (output / "job0.lua").stat().st_nlink == 5
+    assert (output / "job3.lua").read_text() == 'load(pathJoin("hdf5", "1"))\n'
+
+    variants.write_text("job0:\n    content:\n        - modules: [hdf5/2]\n")
+    build(paths, output, incremental=True, dedup=True)
+    assert not (output / "job1.lua").exists()
+    assert (output / "job0.lua").read_text() == 'load(pathJoin("hdf5", "2"))\n'
+    assert len(list(objects.iterdir())) == 5
+
+    def unsupported(*args):
+        raise OSError("hard links are not supported")
+
+    monkeypatch.setattr("os.link", unsupported)
+    symlinked = tmp_path / "symlinked"
+    symlinked.mkdir()
+    build([variants], symlinked, dedup=True)
+    assert (symlinked / "job0.lua").is_symlink()
+    assert (symlinked / "job0.lua").read_text() == 'load(pathJoin("hdf5", "2"))\n'
+    assert (symlinked / LinkingWriter.OBJECTS / LinkingWriter.SYMLINKED).exists()
+
+
+def test_plain_build_keeps_deduplicated_siblings(tmp_path):
+    """A build without dedup replaces a linked script rather than writing
+    through its link, and a stored body edited in place is restored"""
+    stack = tmp_path / "stack.yaml"
+    stack.write_text(
+        "".join(f"j{idx}:\n    whatis: same\n" for idx in range(1, 4)),
+        encoding="utf-8",
+    )
+    build([stack], tmp_path, dedup=True)
+    same = (tmp_path / "j2.lua").read_text()
+    (body,) = (tmp_path / LinkingWriter.OBJECTS).iterdir()
+
+    single = tmp_path / "single.yaml"
+    single.write_text("j1:\n    whatis: one\n", encoding="utf-8")
+    build([single], tmp_path)
+    assert 'whatis("one")' in (tmp_path / "j1.lua").read_text()
+    for name in ("j2.lua", "j3.lua"):
+        assert (tmp_path / name).read_text() == same
+    assert body.read_text() == same
+
+    with open(tmp_path / "j2.lua", "w", encoding="utf-8") as _file:
+        _file.write("edited in place\n")
+    build([stack], tmp_path, dedup=True)
+    for name in ("j1.lua", "j2.lua", "j3.lua"):
+        assert (tmp_path / name).read_text() == same
+    assert body.read_text() == same
+
+
 if __name__ == "__main__":
     for idx, script in enumerate([SAMPLE_1, SAMPLE_2, SAMPLE_3]):
         with open(f"./{idx}.yaml", "w", encoding="utf-8") as _file:
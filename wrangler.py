@@ -1,20 +1,250 @@
 """main execution"""
 
-import argparse
+from __future__ import annotations
+
+import abc
+import functools
+import io
 import itertools
-import json
 import logging
+import marshal
 import os
 import pathlib
+import re
+import select
+import struct
 import sys
+import threading
+import time
+import types
 from pathlib import Path
-from typing import Any, Generator
-
-import yaml
+from queue import Queue
+from typing import Any, Callable, Generator, Iterable, Optional
 
 logger = logging.getLogger(__name__)
 
 
+class LazyModule(types.ModuleType):
+    """a module that is imported on first attribute access
+
+    Most invocations build a handful of files, so interpreter start up
+    dominates their run time.  Modules that only some commands need,
+    PyYAML included, are bound to a `LazyModule` so they are imported by
+    the first command that uses them.  The import is thread safe and is
+    still reported by `python -X importtime`.  The module's namespace is
+    then copied in so later lookups are ordinary attribute lookups.
+    """
+
+    def __getattr__(self, name: str):
+        __import__(self.__name__)
+        module = sys.modules[self.__name__]
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+argparse = LazyModule("argparse")
+asyncio = LazyModule("asyncio")
+cProfile = LazyModule("cProfile")
+futures = LazyModule("concurrent.futures")
+glob = LazyModule("glob")
+hashlib = LazyModule("hashlib")
+json = LazyModule("json")
+shlex = LazyModule("shlex")
+socket = LazyModule("socket")
+sqlite3 = LazyModule("sqlite3")
+tarfile = LazyModule("tarfile")
+yaml = LazyModule("yaml")
+zipfile = LazyModule("zipfile")
+
+YAML_SUFFIXES = (".yaml", ".yml")
+
+LOADERS = ("auto", "c", "python")
+
+SERVER_TIMEOUT = 600.0
+
+
+def get_loader(name: str = "auto"):
+    """returns the yaml loader class for name
+
+    "auto" prefers the libyaml backed loader and falls back to the pure
+    Python loader when PyYAML was built without libyaml.
+    """
+    c_loader = getattr(yaml, "CSafeLoader", None)
+    if name == "auto":
+        return c_loader or yaml.SafeLoader
+    if name == "c":
+        if c_loader is None:
+            raise ValueError("the 'c' loader requires PyYAML built with libyaml")
+        return c_loader
+    if name == "python":
+        return yaml.SafeLoader
+    raise ValueError(f"unknown loader '{name}'")
+
+
+@functools.lru_cache(maxsize=None)
+def c_streaming_loader():
+    """returns the libyaml streaming loader class, defining it on first use"""
+
+    class CStreamingSafeLoader(
+        yaml.cyaml.CParser,
+        yaml.composer.Composer,
+        yaml.constructor.SafeConstructor,
+        yaml.resolver.Resolver,
+    ):
+        """libyaml event parser paired with the Python composer
+
+        libyaml composes whole documents in C, so streaming needs PyYAML's
+        composer to build one node at a time from the libyaml events.
+        """
+
+        def __init__(self, stream):
+            yaml.cyaml.CParser.__init__(self, stream)
+            yaml.composer.Composer.__init__(self)
+            yaml.constructor.SafeConstructor.__init__(self)
+            yaml.resolver.Resolver.__init__(self)
+
+    return CStreamingSafeLoader
+
+
+MERGE_TAG = "tag:yaml.org,2002:merge"
+
+
+def script_nodes(key, value) -> list[tuple[Any, Any]]:
+    """returns the name and data nodes of the scripts a top-level key defines
+
+    A `<<` merge key defines the entries of every mapping merged into the
+    document, in the order PyYAML merges them.
+    """
+    if key.tag != MERGE_TAG:
+        return [(key, value)]
+    merged = value.value if isinstance(value, yaml.SequenceNode) else [value]
+    nodes = []
+    for mapping in reversed(merged):
+        if not isinstance(mapping, yaml.MappingNode):
+            raise yaml.constructor.ConstructorError(
+                None, None, "expected mappings to merge", mapping.start_mark
+            )
+        nodes.extend(mapping.value)
+    return nodes
+
+
+def check_script_names(names: Iterable[Any], seen: set[Any], mark=None):
+    """adds names to seen, warning about any script name already there
+
+    A script defined twice in one document is built from its last
+    definition, by PyYAML and when streaming alike.  `^` templates are
+    not scripts and may repeat.
+    """
+    for name in names:
+        if "^" in str(name):
+            continue
+        if name in seen:
+            logger.warning(
+                "script '%s' is defined more than once%s; using the last", name, mark
+            )
+        seen.add(name)
+
+
+@functools.lru_cache(maxsize=None)
+def document_loader(name: str = "auto"):
+    """returns the loader class for name that warns about duplicate script
+    names"""
+
+    class DocumentLoader(get_loader(name)):
+        """loads documents, checking their top-level script names"""
+
+        def construct_document(self, node):
+            if isinstance(node, yaml.MappingNode):
+                seen: set[Any] = set()
+                for key, _ in node.value:
+                    if key.tag != MERGE_TAG:
+                        check_script_names([key.value], seen, key.start_mark)
+            return super().construct_document(node)
+
+    return DocumentLoader
+
+
+def get_streaming_loader(name: str = "auto"):
+    """returns a loader class for name that can compose one node at a time"""
+    if get_loader(name) is yaml.SafeLoader:
+        return yaml.SafeLoader
+    return c_streaming_loader()
+
+
+class ResolutionContext:
+    """resolves variables from a snapshot of version files and the environment
+
+    The snapshot is loaded once and shared by every translator in a run,
+    so output no longer depends on per-lookup `os.getenv` calls and many
+    version sets can be rendered in one process.  Names that cannot be
+    resolved are recorded in `unresolved` for reporting.
+    """
+
+    __slots__ = ("values", "unresolved")
+
+    REFERENCE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+
+    def __init__(self, values: Optional[dict[str, str]] = None):
+        self.values = dict(values or {})
+        self.unresolved: set[str] = set()
+
+    @classmethod
+    def from_sources(
+        cls,
+        versions_files: Iterable[Path] = (),
+        env_files: Iterable[Path] = (),
+        environment: bool = True,
+    ) -> "ResolutionContext":
+        """builds a context from the environment, env snapshots and versions files
+
+        Later sources take precedence: the live environment is overridden
+        by env snapshot files, which are overridden by versions files.
+        """
+        context = cls(os.environ if environment else None)
+        for env_file in env_files:
+            context.load_env_file(env_file)
+        for versions_file in versions_files:
+            context.load_versions_file(versions_file)
+        return context
+
+    def load_env_file(self, path: Path):
+        """loads `KEY=VALUE` lines, such as the output of `env`"""
+        with open(path, "r", encoding="utf-8") as _file:
+            for line in _file:
+                key, sep, value = line.rstrip("\n").partition("=")
+                if sep and key.isidentifier():
+                    self.values[key] = value
+
+    def load_versions_file(self, path: Path):
+        """loads shell assignments such as the `export hdf5_ver=1.10.6` lines
+        of a `run.ver` file
+
+        References to previously defined variables are expanded.
+        """
+        with open(path, "r", encoding="utf-8") as _file:
+            for line in _file:
+                words = shlex.split(line, comments=True)
+                if words[:1] == ["export"]:
+                    words = words[1:]
+                for word in words:
+                    key, sep, value = word.partition("=")
+                    if sep and key.isidentifier():
+                        self.values[key] = self.expand(value)
+
+    def expand(self, value: str) -> str:
+        """expands `$var` and `${var}` references to known values"""
+        return self.REFERENCE.sub(
+            lambda match: self.values.get(match[1] or match[2], match[0]), value
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        """returns the value of key, recording it as unresolved if unknown"""
+        value = self.values.get(key)
+        if value is None:
+            self.unresolved.add(key)
+        return value
+
+
 class CLI:
     """represents the users response to a CLI input"""
 
@@ -34,98 +264,778 @@ class CLI:
             help="the path for output to be created",
             required=True,
         )
+        self.parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            default=1,
+            help="number of worker processes (0 uses every available core)",
+        )
+        self.parser.add_argument(
+            "--io-threads",
+            type=int,
+            default=0,
+            help="pipeline parsing, translation and writes with this many "
+            "output threads (serial builds only)",
+        )
+        self.parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="skip inputs that are unchanged since the last build",
+        )
+        self.parser.add_argument(
+            "--loader",
+            choices=LOADERS,
+            default="auto",
+            help="yaml loader to use (auto prefers libyaml when available)",
+        )
+        self.parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="write each script as it is parsed to bound memory use",
+        )
+        self.parser.add_argument(
+            "--cache-dir",
+            type=pathlib.Path,
+            help="where parsed inputs are cached between runs "
+            "(defaults to ~/.cache/wrangler/data)",
+        )
+        self.parser.add_argument(
+            "--cache-size",
+            type=int,
+            default=256,
+            help="megabytes of parsed inputs to cache before evicting the least "
+            "recently used",
+        )
+        self.parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="always parse inputs, without reading or writing the cache",
+        )
+        self.parser.add_argument(
+            "--shard",
+            help="build only the scripts of shard K of N, such as 2/8; scripts are "
+            "split by a hash of their names",
+        )
+        self.parser.add_argument(
+            "--library",
+            type=pathlib.Path,
+            action="append",
+            default=[],
+            help="yaml file or directory of shared fragments that scripts "
+            "include by name (repeatable)",
+        )
+        self.parser.add_argument(
+            "--optimize",
+            action="store_true",
+            help="drop repeated loads and overridden setenvs and merge adjacent "
+            "MODULEPATH prepends, reporting the lines and bytes saved",
+        )
+        self.parser.add_argument(
+            "--spider-cache",
+            type=pathlib.Path,
+            help="also write an Lmod spider cache (spiderT.lua and system.txt) "
+            "of the first target's modules to this directory",
+        )
+        self.parser.add_argument(
+            "--dedup",
+            action="store_true",
+            help="store each distinct script once and hard link (or symlink) "
+            "the named files to it, reporting the deduplication ratio",
+        )
+        self.parser.add_argument(
+            "--targets",
+            default="lua",
+            help="comma separated modulefile languages to write from one parse "
+            f"({', '.join(TARGETS)}); several targets each get a subdirectory",
+        )
+        self.parser.add_argument(
+            "--output-format",
+            choices=OUTPUT_FORMATS,
+            default="files",
+            help="write one file per script, or a single tar, zip or sqlite bundle",
+        )
+        self.parser.add_argument(
+            "--stats",
+            choices=("json",),
+            help="print wall and CPU time per phase, throughput and the slowest files",
+        )
+        self.parser.add_argument(
+            "--profile",
+            type=pathlib.Path,
+            help="profile the main process with cProfile and dump pstats here",
+        )
+        self.parser.add_argument(
+            "--log-level",
+            choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+            default="INFO",
+            help="logging verbosity (DEBUG logs every file and write)",
+        )
+        self.parser.add_argument(
+            "--watch",
+            action="store_true",
+            help="after building, rebuild each input as it changes",
+        )
+        self.parser.add_argument(
+            "--versions",
+            type=pathlib.Path,
+            action="append",
+            default=[],
+            help="shell file of version assignments, such as run.ver (repeatable)",
+        )
+        self.parser.add_argument(
+            "--env-file",
+            type=pathlib.Path,
+            action="append",
+            default=[],
+            help="snapshot of KEY=VALUE environment lines (repeatable)",
+        )
+        self.parser.add_argument(
+            "--ignore-environment",
+            action="store_true",
+            help="resolve variables only from --versions and --env-file",
+        )
+        self.parser.add_argument(
+            "--unresolved-report",
+            type=pathlib.Path,
+            help="write a JSON report of unresolved variables to this path",
+        )
+        self.parser.add_argument(
+            "--check-modules",
+            action="store_true",
+            help="check every load and MODULEPATH target exists after building",
+        )
+        self.parser.add_argument(
+            "--modulepath",
+            type=pathlib.Path,
+            action="append",
+            default=[],
+            help="modulepath root to check loads against, in addition to "
+            "$MODULEPATH and the build's own modulepaths (repeatable)",
+        )
+        self.parser.add_argument(
+            "--module-index",
+            type=pathlib.Path,
+            help="where the index used by --check-modules is kept "
+            "(defaults to ~/.cache/wrangler/modules.json)",
+        )
+        self.parser.add_argument(
+            "--server",
+            type=pathlib.Path,
+            help="forward the build to a `wrangler serve` listening on this socket",
+        )
+        self.parser.add_argument(
+            "--server-timeout",
+            type=float,
+            default=SERVER_TIMEOUT,
+            help="seconds to wait for a forwarded build before giving up",
+        )
 
     def get_user_input(self) -> dict[str, Any]:
         """queries the user and returs their input"""
         if len(sys.argv) == 1:
             self.print_help()
         args = self.parser.parse_args()
-        self.validate_output_path(args.output_path)
-        return {"output_path": args.output_path, "queue": self.get_queue(args.files)}
+        self.validate_output_path(args.output_path, args.output_format)
+        for flag in ("incremental", "watch", "shard", "spider_cache", "dedup"):
+            if getattr(args, flag) and args.output_format != "files":
+                logger.error(
+                    "'--%s' requires '--output-format files'", flag.replace("_", "-")
+                )
+                sys.exit(2)
+        for flag in ("incremental", "spider_cache"):
+            if args.shard and getattr(args, flag):
+                logger.error(
+                    "'--shard' cannot be combined with '--%s'", flag.replace("_", "-")
+                )
+                sys.exit(2)
+        for flag in ("watch", "profile", "check_modules", "shard"):
+            if getattr(args, flag) and args.server is not None:
+                logger.error(
+                    "'--%s' cannot be forwarded with '--server'",
+                    flag.replace("_", "-"),
+                )
+                sys.exit(2)
+        context = self.get_context(args)
+        return {
+            "output_path": args.output_path,
+            "queue": self.get_queue(args.files),
+            "jobs": self.validate_jobs(args.jobs),
+            "io_threads": max(args.io_threads, 0),
+            "incremental": args.incremental,
+            "loader": self.validate_loader(args.loader),
+            "targets": self.validate_targets(args.targets),
+            "shard": self.validate_shard(args.shard),
+            "library": self.get_library_files(args.library),
+            "optimize": args.optimize,
+            "spider_cache": args.spider_cache,
+            "dedup": args.dedup,
+            "stream": args.stream,
+            "data_cache": self.get_data_cache(args),
+            "output_format": args.output_format,
+            "context": context,
+            "unresolved_report": args.unresolved_report,
+            "watch": args.watch,
+            "stats": args.stats,
+            "profile": args.profile,
+            "log_level": args.log_level,
+            "server": args.server,
+            "server_timeout": args.server_timeout,
+            "check_modules": args.check_modules,
+            "modulepaths": self.get_modulepaths(args.modulepath, context),
+            "module_index": args.module_index or default_module_index(),
+        }
 
     def print_help(self):
         """prints user help"""
         self.parser.print_help(sys.stderr)
         sys.exit(1)
 
-    def validate_output_path(self, output_path):
-        """validates the output_path is not None and exists"""
+    def validate_output_path(self, output_path, output_format="files"):
+        """validates the output_path is not None and exists
+
+        For bundle output formats the output path is the bundle file, so
+        its parent directory is created instead.
+        """
         if output_path is None:
             logger.error("An output path is required using the '--output_path' flag")
             sys.exit(2)
 
-        if not Path(output_path).exists():
+        if output_format != "files":
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+        elif not Path(output_path).exists():
             logger.warning("'%s' directory does not exist... creating", output_path)
             output_path.mkdir(parents=True, exist_ok=True)
 
+    def validate_jobs(self, jobs: int) -> int:
+        """validates the number of worker processes"""
+        if jobs < 0:
+            logger.error("'--jobs' must be zero or a positive integer")
+            sys.exit(2)
+        return jobs or os.cpu_count() or 1
+
+    def validate_loader(self, loader: str) -> str:
+        """validates the requested yaml loader is available
+
+        Only the "c" loader can be missing, so PyYAML is not imported to
+        validate the others.
+        """
+        if loader != "c":
+            return loader
+        try:
+            get_loader(loader)
+        except ValueError as error:
+            logger.error(str(error))
+            sys.exit(2)
+        return loader
+
+    def validate_targets(self, targets: str) -> tuple[str, ...]:
+        """validates the comma separated output targets"""
+        names = tuple(dict.fromkeys(name.strip() for name in targets.split(",")))
+        unknown = [name for name in names if name not in TARGETS]
+        if unknown or not names:
+            logger.error(
+                "unknown target '%s' (choose from %s)",
+                ",".join(unknown),
+                ", ".join(TARGETS),
+            )
+            sys.exit(2)
+        return names
+
+    def validate_shard(self, shard: Optional[str]) -> Optional[tuple[int, int]]:
+        """validates a `K/N` shard, returning it as a (K, N) pair"""
+        if shard is None:
+            return None
+        index, _, count = shard.partition("/")
+        try:
+            pair = int(index), int(count)
+        except ValueError:
+            pair = (0, 0)
+        if not 1 <= pair[0] <= pair[1]:
+            logger.error("'--shard' must be K/N with 1 <= K <= N, not '%s'", shard)
+            sys.exit(2)
+        return pair
+
+    def get_data_cache(self, args) -> Optional[DataCache]:
+        """returns the cache of parsed inputs, unless it is disabled"""
+        if args.no_cache:
+            return None
+        if args.cache_size < 0:
+            logger.error("'--cache-size' must be zero or a positive integer")
+            sys.exit(2)
+        return DataCache(args.cache_dir or cache_home() / "data", args.cache_size << 20)
+
+    def get_library_files(self, _paths: list[pathlib.Path]) -> list[Path]:
+        """returns the fragment library files, which are never built as inputs"""
+        files = []
+        for _path in _paths:
+            matches = self.expand_path(_path)
+            if not matches or not all(match.is_file() for match in matches):
+                logger.error("'%s' does not match any library files", _path)
+                sys.exit(2)
+            files.extend(match for match in matches if match not in files)
+        return files
+
+    def get_context(self, args) -> ResolutionContext:
+        """loads the variable resolution context for the run"""
+        try:
+            return ResolutionContext.from_sources(
+                args.versions, args.env_file, not args.ignore_environment
+            )
+        except (OSError, ValueError) as error:
+            logger.error("unable to load variables (%s)", error)
+            sys.exit(2)
+
+    def get_modulepaths(
+        self, _paths: list[pathlib.Path], context: ResolutionContext
+    ) -> list[str]:
+        """returns the modulepath roots loads are checked against"""
+        modulepath = context.values.get("MODULEPATH", "")
+        return [str(_path) for _path in _paths] + [
+            _path for _path in modulepath.split(":") if _path
+        ]
+
     def get_queue(self, _paths: list[pathlib.Path]) -> Generator[Path, None, None]:
-        """creates generator of files for parsing"""
+        """creates generator of files for parsing
+
+        Directories are searched recursively for yaml files and glob
+        patterns are expanded.  Expanded paths are sorted and each file
+        is only yielded once so runs are reproducible.  A directory or
+        pattern that matches no files is an error.
+        """
+        seen = set()
         for _path in _paths:
-            if _path.is_dir():
-                raise AttributeError(f"{_path} is a directory")
-            yield _path
+            files = self.expand_path(_path)
+            if not files:
+                logger.error("'%s' does not match any yaml files", _path)
+                sys.exit(2)
+            for _file in files:
+                if _file not in seen:
+                    seen.add(_file)
+                    yield _file
+
+    def expand_path(self, _path: pathlib.Path) -> list[Path]:
+        """expands a directory or glob pattern into the files it refers to"""
+        if _path.is_dir():
+            return sorted(
+                _file
+                for _file in _path.rglob("*")
+                if _file.suffix in YAML_SUFFIXES and _file.is_file()
+            )
+        if glob.has_magic(str(_path)):
+            matches = []
+            for match in sorted(glob.glob(str(_path), recursive=True)):
+                matches.extend(self.expand_path(Path(match)))
+            return matches
+        return [_path]
 
 
 class RequiredInputMissing(Exception):
     """Raised when a required input is missing"""
 
 
-class LuaTranslator:
-    """Translates key, value pairs to Lua commands"""
+TEMPLATE_REFERENCE = re.compile(r"\$\{(\w+)(?::-([^}]*))?\}")
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(text: str) -> tuple[Any, ...]:
+    """compiles a string into its literal text and `${var}` references
+
+    Literal text is kept as strings and each reference becomes a
+    `(name, default)` pair, with the default of `${var:-default}` or
+    None.  Templates are cached, so the strings repeated across
+    thousands of scripts are only compiled once.
+    """
+    parts: list[Any] = []
+    position = 0
+    for match in TEMPLATE_REFERENCE.finditer(text):
+        if match.start() > position:
+            parts.append(text[position : match.start()])
+        parts.append((match[1], match[2]))
+        position = match.end()
+    if position < len(text):
+        parts.append(text[position:])
+    return tuple(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def split_module(text: str) -> tuple[str, Optional[str]]:
+    """splits a module string into its name and version templates
+
+    The version follows the last `/` outside of any `${var}` reference,
+    so names may have several components.  A module without a version,
+    or with an empty one, returns None for the version.
+    """
+    references = [match.span() for match in TEMPLATE_REFERENCE.finditer(text)]
+    position = len(text)
+    while True:
+        position = text.rfind("/", 0, position)
+        if position < 0:
+            return text, None
+        if not any(start <= position < end for start, end in references):
+            break
+    name, version = text[:position], text[position + 1 :]
+    return (name, version) if version else (name, None)
 
-    def __init__(self):
-        pass
+
+class Translator(abc.ABC):
+    """Base class for translators of key, value pairs to output commands
+
+    Subclasses map input keys to the names of their translation methods
+    in `commands`.  The map is compiled into a table of functions once
+    per class, rather than per call.  The parsing of module references
+    is shared, and subclasses format it with `load` and
+    `environment_lookup`.  Scripts are written to files named with
+    `extension`, starting with `header`.
+
+    `include` items are looked up in `library`, and their translations
+    are kept in `imported`, which every translator of a build shares.
+
+    With `optimize`, rendered content is passed through `minimize`, which
+    recognizes loads by `load_prefix` and variable and modulepath changes
+    by `setenv_pattern` and `modulepath_pattern`.  The lines and bytes it
+    removes are added up in `saved`.
+    """
+
+    target = ""
+    extension = ""
+    header = ""
+    load_prefix = ""
+    setenv_pattern: re.Pattern = re.compile("(?!)")
+    modulepath_pattern: re.Pattern = re.compile("(?!)")
+    commands: dict[str, str] = {}
+    _dispatch: dict[str, Callable[..., list[str]]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch = {
+            key: getattr(cls, method) for key, method in cls.commands.items()
+        }
+
+    def __init__(self, context: Optional[ResolutionContext] = None):
+        if context is None:
+            context = ResolutionContext.from_sources()
+        self.context = context
+        self.resolved: dict[str, Optional[str]] = {}
+        self.references: dict[str, set[str]] = {"load": set(), "modulepath": set()}
+        self.shared: set[int] = set()
+        self.fragments: dict[tuple[str, int], tuple[Any, list[str]]] = {}
+        self.library: Optional[FragmentLibrary] = None
+        self.imported: dict[tuple[str, str], tuple[list[str], dict, dict]] = {}
+        self.including: set[str] = set()
+        self.optimize = False
+        self.saved = [0, 0]
 
     def __call__(self, key, value):
         """executes the function on value returned by key lookup
 
-        Allows use of any translator that follows this interface
+        Allows use of any translator that follows this interface.  Values
+        marked with `share` are translated once and the result reused.
         """
-        _map = {
-            "modules": self.modules,
-            "modulepaths": self.module_paths,
-            "environment": self.environment,
-            "help": self._help,
-            "whatis": self.what_is,
-        }
-        return _map.get(key, lambda x: x)(value)
+        function = self._dispatch.get(key)
+        if function is None:
+            return value
+        if id(value) not in self.shared:
+            return function(self, value)
+        fragment = self.fragments.get((key, id(value)))
+        if fragment is None or fragment[0] is not value:
+            fragment = self.fragments[key, id(value)] = (value, function(self, value))
+        return list(fragment[1])
+
+    def share(self, values: Iterable[Any]):
+        """marks values referenced from several places, such as the nodes of
+        merged `^` anchors, so their translations are cached and reused
+
+        Cached fragments keep a reference to their value, so an id reused
+        by a different object is never mistaken for a shared fragment.
+        """
+        self.shared.update(id(value) for value in values)
+
+    def follow(self, leader: Translator):
+        """shares the values marked on leader, so scripts leader parsed can be
+        rendered by this translator too
+
+        Cached fragments are dropped once leader forgets its shared values.
+        """
+        if self.shared is not leader.shared:
+            self.shared = leader.shared
+            self.fragments = {}
+
+    def forget(self):
+        """drops shared values and cached fragments, such as between documents"""
+        self.shared = set()
+        self.fragments = {}
+
+    def render(self, data: dict[str, Any]) -> str:
+        """renders a script's data into a single string
+
+        Commands are written straight into one buffer in the same order
+        as `Script.lines`, without building intermediate lists of lines.
+        """
+        dispatch = self._dispatch
+        buffer = io.StringIO()
+        buffer.write(self.header)
+        write = buffer.writelines
+        write(dispatch["help"](self, data.get("help", None)))
+        if self.optimize:
+            lines = [
+                line
+                for item in data.get("content", [])
+                for key, value in item.items()
+                for line in self(key, value)
+            ]
+            kept = self.minimize(lines)
+            self.saved[0] += len(lines) - len(kept)
+            self.saved[1] += len("".join(lines).encode("utf-8")) - len(
+                "".join(kept).encode("utf-8")
+            )
+            write(kept)
+        else:
+            for item in data.get("content", []):
+                for key, value in item.items():
+                    write(self(key, value))
+        write(dispatch["whatis"](self, data.get("whatis", None)))
+        return buffer.getvalue()
+
+    def minimize(self, lines: list[str]) -> list[str]:
+        """returns content lines without commands that cannot change the
+        environment a script loads into
+
+        Repeated loads are dropped, since loading a loaded module does
+        nothing.  A `setenv` is dropped when a later one sets the same
+        variable and nothing in between, such as a load, could read it.
+        Runs of adjacent MODULEPATH prepends are merged into one command.
+        The order of everything kept is unchanged.
+        """
+        loaded: set[str] = set()
+        unique = []
+        for line in lines:
+            if line.startswith(self.load_prefix):
+                if line in loaded:
+                    continue
+                loaded.add(line)
+            unique.append(line)
+
+        kept: list[str] = []
+        overridden: set[str] = set()
+        for line in reversed(unique):
+            match = self.setenv_pattern.match(line)
+            if match is not None and match.group(1) in overridden:
+                continue
+            if line.startswith(self.load_prefix):
+                overridden = set()
+            elif overridden:
+                overridden = {
+                    key
+                    for key in overridden
+                    if self.environment_lookup(key) not in line
+                }
+                if self.modulepath_pattern.match(line):
+                    overridden.discard("MODULEPATH")
+            if match is not None:
+                key = match.group(1)
+                if self.environment_lookup(key) not in line:
+                    overridden.add(key)
+            kept.append(line)
+        kept.reverse()
+
+        merged: list[str] = []
+        run: list[tuple[str, str]] = []
+        for line in kept:
+            match = self.modulepath_pattern.match(line)
+            if match is not None and all(match.group(1) != path for path, _ in run):
+                run.append((match.group(1), line))
+                continue
+            merged.extend(self.prepend_modulepaths(run))
+            run = [] if match is None else [(match.group(1), line)]
+            if match is None:
+                merged.append(line)
+        merged.extend(self.prepend_modulepaths(run))
+        return merged
+
+    def prepend_modulepaths(self, run: list[tuple[str, str]]) -> list[str]:
+        """returns a run of adjacent (path, line) MODULEPATH prepends as one
+        command, which leaves the last prepended path first"""
+        if len(run) < 2:
+            return [line for _, line in run]
+        return [self.prepend_paths([path for path, _ in reversed(run)])]
+
+    @classmethod
+    def filename(cls, name: str, subtree: bool = False) -> str:
+        """returns the output file name of a script, under the target's
+        subtree when several targets are written together"""
+        if subtree:
+            return f"{cls.target}/{name}{cls.extension}"
+        return f"{name}{cls.extension}"
 
     def ensure_list(self, value):
         """ensures a value is a list or coerces to list of len 1"""
         return value if isinstance(value, list) else [value]
 
-    def module_paths(self, values: list[str]) -> list[str]:
-        """returns lua module path commands"""
-        if not values:
-            return []
-        return [
-            f'prepend_path("MODULEPATH", pathJoin("{_path}"))\n'
-            for _path in values
-            if _path != "None"
-        ]
-
     def modules(self, values: list[str]) -> list[str]:
-        """returns list of lua module commands
+        """returns list of module load commands
 
-        Environment variables are translated if they exist in the
-        environtment.  Otherwise, returns the environment lookup as
-        a Lua command.
+        Modules are split into a name and a version at their last `/`,
+        and `${var}` references in either are interpolated.  Every load
+        target that is known is recorded in `references`.
         """
         results = []
         if not values:
             return results
+        load, loads = self.load, self.references["load"]
         for value in self.ensure_list(values):
-            try:
-                key, _value = value.split("/")
-                if len(_value) and _value[:2] != "${":
-                    results.append(f'load(pathJoin("{key}", "{_value}"))\n')
-                else:
-                    env_value = self.get_environment_value(_value[2:-1])
-                    results.append(f'load(pathJoin("{key}", "{env_value}"))\n')
-            except ValueError:
-                results.append(f'load(pathJoin("{value}"))\n')
+            name, version = split_module(str(value))
+            name, known = self.interpolate(name)
+            if version is None:
+                results.append(load(name))
+                if known:
+                    loads.add(name)
+                continue
+            version, known_version = self.interpolate(version)
+            results.append(load(name, version))
+            if known and known_version:
+                loads.add(f"{name}/{version}")
+        return results
+
+    def include(self, names) -> list[str]:
+        """returns the commands of the named library fragments
+
+        Each fragment is translated once per build.  The variables and
+        references it recorded are replayed for every later script that
+        includes it, along with the library file it came from.
+        """
+        results = []
+        for name in self.ensure_list(names):
+            name = str(name)
+            entry = self.imported.get((self.target, name))
+            if entry is None:
+                entry = self.imported[self.target, name] = self.translate_fragment(name)
+            lines, resolved, references = entry
+            self.resolved.update(resolved)
+            for kind, values in references.items():
+                self.references.setdefault(kind, set()).update(values)
+            results.extend(lines)
+        return results
+
+    def translate_fragment(
+        self, name: str
+    ) -> tuple[list[str], dict[str, Optional[str]], dict[str, set[str]]]:
+        """translates a library fragment, returning its lines and the
+        variables and references it recorded"""
+        if self.library is None:
+            raise ValueError(f"'{name}' is included without a fragment library")
+        if name in self.including:
+            raise ValueError(f"fragment '{name}' includes itself")
+        items, source = self.library.fragment(name)
+        saved = self.resolved, self.references
+        self.resolved = {}
+        self.references = {"load": set(), "modulepath": set(), "library": {source}}
+        self.including.add(name)
+        try:
+            lines = [
+                line
+                for item in items
+                for key, value in item.items()
+                for line in self(key, value)
+            ]
+            return lines, self.resolved, self.references
+        finally:
+            self.including.discard(name)
+            self.resolved, self.references = saved
+
+    def interpolate(self, text: str) -> tuple[str, bool]:
+        """returns text with its `${var}` references substituted, and whether
+        every reference was resolved
+
+        Variables missing from the context take the default of a
+        `${var:-default}` reference, or are rendered as a lookup at load
+        time otherwise.
+        """
+        if "${" not in text:
+            return text, True
+        rendered, known = [], True
+        for part in compile_template(text):
+            if isinstance(part, str):
+                rendered.append(part)
+                continue
+            name, default = part
+            value = self.resolved[name] = self.context.get(name)
+            if value is None:
+                value = default
+            if value is None:
+                known = False
+                value = self.environment_lookup(name)
+            rendered.append(value)
+        return "".join(rendered), known
+
+    @abc.abstractmethod
+    def load(self, name: str, version: Optional[str] = None) -> str:
+        """returns the command loading a module"""
+
+    @abc.abstractmethod
+    def prepend_paths(self, paths: list[str]) -> str:
+        """returns a command prepending paths to MODULEPATH in the given order"""
+
+    def get_environment_value(self, key) -> str:
+        """returns the context value if it exists or an environment lookup otherwise
+
+        Every lookup is recorded in `resolved` so incremental builds can
+        tell when a change in the environment affects the output.
+        """
+        value = self.resolved[key] = self.context.get(key)
+        if value is None:
+            value = self.environment_lookup(key)
+        return value
+
+    @abc.abstractmethod
+    def environment_lookup(self, key: str) -> str:
+        """returns the command looking up an environment variable at load time"""
+
+
+class LuaTranslator(Translator):
+    """Translates key, value pairs to Lua commands"""
+
+    target = "lua"
+    extension = ".lua"
+    load_prefix = "load("
+    setenv_pattern = re.compile(r'setenv\("([^"]*)", ')
+    modulepath_pattern = re.compile(
+        r'prepend_path\("MODULEPATH", pathJoin\("(.*)"\)\)\n'
+    )
+
+    commands = {
+        "modules": "modules",
+        "modulepaths": "module_paths",
+        "environment": "environment",
+        "include": "include",
+        "help": "_help",
+        "whatis": "what_is",
+    }
+
+    def module_paths(self, values: list[str]) -> list[str]:
+        """returns lua module path commands"""
+        if not values:
+            return []
+        results = []
+        for _path in values:
+            if _path == "None":
+                continue
+            _path, known = self.interpolate(str(_path))
+            if known:
+                self.references["modulepath"].add(_path)
+            results.append(f'prepend_path("MODULEPATH", pathJoin("{_path}"))\n')
         return results
 
+    def prepend_paths(self, paths: list[str]) -> str:
+        """returns a lua command prepending paths to MODULEPATH in order"""
+        return f'prepend_path("MODULEPATH", "{":".join(paths)}")\n'
+
+    def load(self, name: str, version: Optional[str] = None) -> str:
+        """returns a lua module load command"""
+        if version is None:
+            return f'load(pathJoin("{name}"))\n'
+        return f'load(pathJoin("{name}", "{version}"))\n'
+
     def environment(self, values: list[dict[str, Any]]) -> list[str]:
         """returns list of lua environment variable commands"""
 
@@ -134,15 +1044,14 @@ class LuaTranslator:
             return results
         for value in self.ensure_list(values):
             for key, value in value.items():
-                results.append(f'setenv("{key}", "{value}")\n')
+                results.append(
+                    f'setenv("{key}", "{self.interpolate(str(value))[0]}")\n'
+                )
         return results
 
-    def get_environment_value(self, key) -> str:
-        """returns the os environment value if it exists or a lua environment lookup otherwise"""
-        value = os.getenv(key)
-        if value is None:
-            value = f"os.getenv({key})"
-        return value
+    def environment_lookup(self, key: str) -> str:
+        """returns a lua lookup of an environment variable"""
+        return f"os.getenv({key})"
 
     def what_is(self, values: list[str]) -> list[str]:
         """returns list Lua whatis commands"""
@@ -157,95 +1066,3049 @@ class LuaTranslator:
         return [f"help([[{value}]])\n" for value in self.ensure_list(values)]
 
 
-class Script:
-    """represents a Script whose data is to be parsed and translated"""
+class TclTranslator(Translator):
+    """Translates key, value pairs to Tcl modulefile commands for
+    Environment Modules"""
 
-    def __init__(self, name, data, translator):
-        self.name = name
-        self.data = data
-        self.translator = translator
+    target = "tcl"
+    header = "#%Module1.0\n"
+    load_prefix = "module load "
+    setenv_pattern = re.compile(r"setenv (\S+) ")
+    modulepath_pattern = re.compile(r"prepend-path MODULEPATH (.*)\n")
 
-    def __str__(self):
-        return str(list(itertools.chain(self.help, self.content, self.whatis)))
+    commands = {
+        "modules": "modules",
+        "modulepaths": "module_paths",
+        "environment": "environment",
+        "include": "include",
+        "help": "_help",
+        "whatis": "what_is",
+    }
 
-    def __repr__(self):
-        props = self.__dict__.copy()
-        props.pop("translator")
-        return json.dumps(props)
+    def module_paths(self, values: list[str]) -> list[str]:
+        """returns tcl module path commands"""
+        if not values:
+            return []
+        results = []
+        for _path in values:
+            if _path == "None":
+                continue
+            _path, known = self.interpolate(str(_path))
+            if known:
+                self.references["modulepath"].add(_path)
+            results.append(f"prepend-path MODULEPATH {self.word(_path, known)}\n")
+        return results
 
-    @property
-    def content(self):
-        """returns the content translated by translator or an empty list"""
-        value = self.data.get("content", [])
-        return list(
-            itertools.chain(
-                *[
-                    self.translator(key, content)
-                    for item in value
-                    for key, content in item.items()
-                ]
-            )
-        )
+    def prepend_paths(self, paths: list[str]) -> str:
+        """returns a tcl command prepending path words to MODULEPATH in order"""
+        return f"prepend-path MODULEPATH {' '.join(paths)}\n"
 
-    @property
-    def help(self):
-        """returns the help translated by translator or None"""
-        return self.translator("help", self.data.get("help", None))
+    def word(self, text: str, known: bool = True) -> str:
+        """returns text as one tcl word, substituting lookups unless known"""
+        return f"{{{text}}}" if known else f'"{text}"'
 
-    @property
-    def whatis(self):
-        """returns the whatis translated by translator or None"""
-        return self.translator("whatis", self.data.get("whatis", None))
+    def load(self, name: str, version: Optional[str] = None) -> str:
+        """returns a tcl module load command"""
+        if version is None:
+            return f"module load {name}\n"
+        return f"module load {name}/{version}\n"
 
+    def environment(self, values: list[dict[str, Any]]) -> list[str]:
+        """returns list of tcl environment variable commands"""
+        results = []
+        if not values:
+            return results
+        for value in self.ensure_list(values):
+            for key, value in value.items():
+                results.append(
+                    f"setenv {key} {self.word(*self.interpolate(str(value)))}\n"
+                )
+        return results
+
+    def environment_lookup(self, key: str) -> str:
+        """returns a tcl lookup of an environment variable"""
+        return f"$env({key})"
+
+    def what_is(self, values: list[str]) -> list[str]:
+        """returns list of tcl whatis commands"""
+        if not values:
+            return []
+        return [f"module-whatis {{{value}}}\n" for value in self.ensure_list(values)]
+
+    def _help(self, values: list[str]) -> list[str]:
+        """returns a tcl ModulesHelp procedure printing the help"""
+        if not values:
+            return []
+        return [
+            "proc ModulesHelp { } {\n",
+            *(f"    puts stderr {{{value}}}\n" for value in self.ensure_list(values)),
+            "}\n",
+        ]
+
+
+TARGETS: dict[str, type[Translator]] = {"lua": LuaTranslator, "tcl": TclTranslator}
+
+
+class Script:
+    """represents a Script whose data is to be parsed and translated
+
+    The translation is rendered once, on first use, into an immutable
+    (help, content, whatis) tuple that is reused by every accessor.
+    `text`, which is what builds write, is rendered once by the
+    translator's compiled `render` instead.  Assigning `data` or
+    `translator` discards the rendered forms; call `invalidate` after
+    mutating `data` in place.
+    """
+
+    __slots__ = ("name", "_data", "_translator", "_rendered", "_text")
+
+    def __init__(self, name, data, translator):
+        self.name = name
+        self._data = data
+        self._translator = translator
+        self._rendered = None
+        self._text = None
+
+    def __str__(self):
+        return str(list(self.lines))
+
+    def __repr__(self):
+        return json.dumps({"name": self.name, "data": self.data})
+
+    @property
+    def data(self):
+        """returns the parsed data for the script"""
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.invalidate()
+
+    @property
+    def translator(self):
+        """returns the translator used to render the script"""
+        return self._translator
+
+    @translator.setter
+    def translator(self, value):
+        self._translator = value
+        self.invalidate()
+
+    def invalidate(self):
+        """discards the rendered translation so it is rebuilt on next access"""
+        self._rendered = None
+        self._text = None
+
+    @property
+    def rendered(self) -> tuple[tuple[str, ...], tuple[str, ...], tuple[str, ...]]:
+        """returns the translated (help, content, whatis), rendering it once"""
+        if self._rendered is None:
+            translator = self._translator
+            content = list(
+                itertools.chain.from_iterable(
+                    translator(key, content)
+                    for item in self._data.get("content", [])
+                    for key, content in item.items()
+                )
+            )
+            if translator.optimize:
+                content = translator.minimize(content)
+            self._rendered = (
+                tuple(translator("help", self._data.get("help", None))),
+                tuple(content),
+                tuple(translator("whatis", self._data.get("whatis", None))),
+            )
+        return self._rendered
+
+    @property
+    def lines(self) -> tuple[str, ...]:
+        """returns every translated line, after any header, in the order it
+        is written"""
+        lines = itertools.chain.from_iterable(self.rendered)
+        header = self._translator.header
+        return tuple(itertools.chain((header,), lines) if header else lines)
+
+    @property
+    def text(self) -> str:
+        """returns the translated script as a single string, rendering it once"""
+        if self._text is None:
+            self._text = self._translator.render(self._data)
+        return self._text
+
+    @property
+    def content(self):
+        """returns the content translated by translator or an empty list"""
+        return list(self.rendered[1])
+
+    @property
+    def help(self):
+        """returns the help translated by translator or None"""
+        return list(self.rendered[0])
+
+    @property
+    def whatis(self):
+        """returns the whatis translated by translator or None"""
+        return list(self.rendered[2])
 
-def queue(_files):
+
+def retarget(
+    scripts: Iterable[Script], translators: list[Translator]
+) -> Generator[Script, None, None]:
+    """yields each script, parsed with the first translator, once per translator
+
+    The yaml is parsed once and every target renders the same data.
+    """
+    leader, *followers = translators
+    for script in scripts:
+        yield script
+        for translator in followers:
+            translator.follow(leader)
+            yield Script(script.name, script.data, translator)
+
+
+def shard_of(name: str, count: int) -> int:
+    """returns the shard, from 1 to count, that builds the script name
+
+    Scripts are split by a hash of their name rather than of their input,
+    so shards stay balanced when one file holds most of the scripts, and
+    every node agrees on the split without coordinating.
+    """
+    return int(hash_bytes(name.encode("utf-8"))[:16], 16) % count + 1
+
+
+def select_shard(
+    scripts: Iterable[Script],
+    shard: Optional[tuple[int, int]],
+    others: list[str],
+) -> Iterable[Script]:
+    """yields the scripts of shard, a (K, N) pair, adding the names of the
+    scripts left to other shards to others"""
+    if shard is None:
+        yield from scripts
+        return
+    index, count = shard
+    for script in scripts:
+        if shard_of(script.name, count) == index:
+            yield script
+        else:
+            others.append(script.name)
+
+
+def describe_scripts(
+    scripts: Iterable[Script], modules: Optional[list[dict[str, Any]]]
+) -> Iterable[Script]:
+    """yields scripts, adding what the spider cache records about each one
+    to modules once it has been consumed"""
+    for script in scripts:
+        yield script
+        if modules is not None:
+            modules.append(spider_entry(script))
+
+
+def spider_entry(script: Script) -> dict[str, Any]:
+    """returns the name, help, whatis and known MODULEPATH additions of a
+    script, as Lmod's spider cache records them"""
+    data, translator = script.data, script.translator
+    return {
+        "name": script.name,
+        "help": "\n".join(
+            str(value) for value in translator.ensure_list(data.get("help") or [])
+        ),
+        "whatis": [
+            str(value) for value in translator.ensure_list(data.get("whatis") or [])
+        ],
+        "modulepaths": content_modulepaths(data.get("content", []), translator),
+    }
+
+
+def content_modulepaths(
+    items: Iterable[dict[str, Any]], translator: Translator, seen=None
+) -> list[str]:
+    """returns the resolved modulepaths content items prepend, following
+    `include` items into the translator's library once each"""
+    seen = set() if seen is None else seen
+    paths: list[str] = []
+    for item in items:
+        for key, value in item.items():
+            if key == "modulepaths" and value:
+                for _path in translator.ensure_list(value):
+                    if _path == "None":
+                        continue
+                    _path, known = translator.interpolate(str(_path))
+                    if known and _path not in paths:
+                        paths.append(_path)
+            elif key == "include" and translator.library is not None:
+                for name in translator.ensure_list(value):
+                    if str(name) in seen:
+                        continue
+                    seen.add(str(name))
+                    fragment = translator.library.fragment(str(name))[0]
+                    for _path in content_modulepaths(fragment, translator, seen):
+                        if _path not in paths:
+                            paths.append(_path)
+    return paths
+
+
+def parse_scripts(stream, translator, loader: str = "auto") -> list[Script]:
+    """parses a yaml stream or string into Script instances
+
+    Content values that PyYAML hands back as the same object for several
+    scripts, such as merged anchors, are shared with the translator.
+    """
+    return scripts_from_data(
+        yaml.load(stream, Loader=document_loader(loader)), translator
+    )
+
+
+def scripts_from_data(data: dict[str, Any], translator) -> list[Script]:
+    """builds Script instances from an already parsed mapping of scripts"""
+    scripts = [
+        Script(script_name, script_data, translator)
+        for (script_name, script_data) in data.items()
+        if "^" not in script_name
+    ]
+    translator.share(shared_fragments(script.data for script in scripts))
+    return scripts
+
+
+def shared_fragments(documents: Iterable[dict[str, Any]]) -> list[Any]:
+    """returns the content values referenced by more than one content item"""
+    seen: dict[int, Any] = {}
+    shared = {}
+    for data in documents:
+        content = data.get("content", None) if isinstance(data, dict) else None
+        for item in content if isinstance(content, list) else []:
+            for value in item.values() if isinstance(item, dict) else []:
+                if id(value) in seen:
+                    shared[id(value)] = value
+                else:
+                    seen[id(value)] = value
+    return list(shared.values())
+
+
+def load_scripts(_file, translator, loader: str = "auto") -> list[Script]:
+    """parses a single yaml file into Script instances"""
+    with open(_file, "r", encoding="utf-8") as stream:
+        return parse_scripts(stream, translator, loader)
+
+
+def stream_scripts(stream, translator, loader: str = "auto"):
+    """parses a yaml stream into Script instances one top-level key at a time
+
+    Multi-document (`---` separated) streams are supported.  Anchored
+    nodes, and the objects built from them, are kept until the end of
+    their document so `^` templates can still be merged and are shared
+    with the translator.  Every other node is released once its script
+    has been yielded.  Top-level `<<` merges yield the scripts they
+    merge.  As with `parse_scripts`, the last definition of a script
+    wins, and a script defined by a key is never replaced by a merge.
+    """
+    parser = get_streaming_loader(loader)(stream)
+    parser.retained = set()
+    parser.anchor_count = 0
+    parser.names = set()
+    try:
+        parser.get_event()
+        while not parser.check_event(yaml.StreamEndEvent):
+            parser.get_event()
+            if parser.check_event(yaml.MappingStartEvent):
+                parser.get_event()
+                while not parser.check_event(yaml.MappingEndEvent):
+                    yield from stream_item(parser, translator)
+                parser.get_event()
+            elif parser.construct_document(parser.compose_node(None, None)):
+                raise AttributeError("yaml documents must be mappings of scripts")
+            parser.get_event()
+            parser.anchors = {}
+            parser.constructed_objects = {}
+            parser.retained = set()
+            parser.anchor_count = 0
+            parser.names = set()
+            translator.forget()
+    finally:
+        parser.dispose()
+
+
+def stream_item(parser, translator) -> Generator[Script, None, None]:
+    """composes the next top-level key and value, yielding any Scripts"""
+    key = parser.compose_node(None, None)
+    node = parser.compose_node(None, None)
+    nodes = script_nodes(key, node)
+    names = [parser.construct_object(name) for name, _ in nodes]
+    if key.tag == MERGE_TAG:
+        keep = [name not in parser.names for name in names]
+    else:
+        check_script_names(names, parser.names, key.start_mark)
+        keep = [True]
+    scripts = [
+        (name, parser.construct_object(value, deep=True))
+        for name, (_, value), kept in zip(names, nodes, keep)
+        if kept and "^" not in str(name)
+    ]
+    if len(parser.anchors) != parser.anchor_count:
+        parser.anchor_count = len(parser.anchors)
+        parser.retained = descendants(parser.anchors.values())
+    parser.constructed_objects = {
+        key: value
+        for key, value in parser.constructed_objects.items()
+        if id(key) in parser.retained
+    }
+    translator.share(parser.constructed_objects.values())
+    for script_name, data in scripts:
+        yield Script(script_name, data, translator)
+
+
+def descendants(nodes: Iterable[yaml.Node]) -> set[int]:
+    """returns the ids of nodes and every node nested beneath them"""
+    found: set[int] = set()
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if id(node) in found:
+            continue
+        found.add(id(node))
+        if isinstance(node, yaml.SequenceNode):
+            pending.extend(node.value)
+        elif isinstance(node, yaml.MappingNode):
+            for key, value in node.value:
+                pending.extend((key, value))
+    return found
+
+
+def queue(
+    _files,
+    loader: str = "auto",
+    context: Optional[ResolutionContext] = None,
+    target: str = "lua",
+):
     """parses _files into Script instances"""
+    if context is None:
+        context = ResolutionContext.from_sources()
     for _file in _files:
         logging.debug("queueing %s", _file)
-        with open(_file, "r", encoding="utf-8") as _file:
-            translator = LuaTranslator()
+        try:
+            yield load_scripts(_file, TARGETS[target](context), loader)
+        except (AttributeError, yaml.parser.ParserError) as error:
+            logging.error(
+                "Invalid YAML file detected. [CTRL-C] to quit. (%s)", str(error)
+            )
+
+
+def build_errors() -> tuple[type[Exception], ...]:
+    """returns the errors that fail a single input rather than the whole run
+
+    Used as `except build_errors()`, which is only evaluated once an
+    error is raised, so catching them does not import PyYAML.
+    """
+    return (OSError, AttributeError, TypeError, ValueError, yaml.YAMLError)
+
+
+class RenderError:
+    """describes an input or script that could not be rendered"""
+
+    __slots__ = ("source", "script", "message")
+
+    def __init__(self, source: int, script: Optional[str], message: str):
+        self.source = source
+        self.script = script
+        self.message = message
+
+    def __repr__(self):
+        return json.dumps(self.as_dict())
+
+    def as_dict(self) -> dict[str, Any]:
+        """returns the error as a JSON serializable dict"""
+        return {"source": self.source, "script": self.script, "message": self.message}
+
+
+class RenderResult:
+    """represents the scripts rendered from one or more inputs"""
+
+    __slots__ = ("scripts", "errors")
+
+    def __init__(self):
+        self.scripts: dict[str, str] = {}
+        self.errors: list[RenderError] = []
+
+    @property
+    def ok(self) -> bool:
+        """returns True if every input and script rendered without error"""
+        return not self.errors
+
+
+class Renderer:
+    """renders yaml text or parsed data to scripts entirely in memory
+
+    Nothing is read from or written to disk, and errors are returned on
+    the result rather than raised or logged.  A renderer keeps a single
+    translator, so its resolution context is loaded once and reused by
+    every call.
+    """
+
+    def __init__(
+        self,
+        context: Optional[ResolutionContext] = None,
+        loader: str = "auto",
+        translator: Optional[Translator] = None,
+    ):
+        self.loader = document_loader(loader)
+        self.translator = translator or LuaTranslator(context)
+
+    def render(self, source) -> RenderResult:
+        """renders one input, or a list of inputs, into a single result
+
+        An input is yaml text (str or bytes, which may hold several `---`
+        separated documents) or an already parsed dict of scripts.
+        """
+        sources = source if isinstance(source, list) else [source]
+        result = RenderResult()
+        try:
+            for idx, item in enumerate(sources):
+                self.render_source(idx, item, result)
+        finally:
+            self.translator.forget()
+        return result
+
+    def render_batch(self, sources: Iterable[Any]) -> list[RenderResult]:
+        """renders each input into its own result
+
+        The translator, and the fragments it has cached, are reused across
+        the whole batch, so data shared between inputs is translated once.
+        """
+        try:
+            return [self.render_one(source) for source in sources]
+        finally:
+            self.translator.forget()
+
+    def render_one(self, source) -> RenderResult:
+        """renders a single input without dropping cached fragments"""
+        result = RenderResult()
+        self.render_source(0, source, result)
+        return result
+
+    def render_source(self, idx: int, source, result: RenderResult):
+        """renders the documents of one input into result"""
+        if isinstance(source, dict):
+            documents: Iterable[Any] = [source]
+        else:
+            documents = yaml.load_all(source, Loader=self.loader)
+        try:
+            documents = list(documents)
+        except yaml.YAMLError as error:
+            result.errors.append(RenderError(idx, None, f"YAMLError: {error}"))
+            return
+        self.translator.share(
+            shared_fragments(
+                data
+                for document in documents
+                if isinstance(document, dict)
+                for data in document.values()
+            )
+        )
+        for document in documents:
+            if document is None:
+                continue
+            if not isinstance(document, dict):
+                message = "AttributeError: yaml documents must be mappings of scripts"
+                result.errors.append(RenderError(idx, None, message))
+                continue
+            for name, data in document.items():
+                if "^" in str(name):
+                    continue
+                self.render_script(idx, str(name), data, result)
+
+    def render_script(self, idx: int, name: str, data, result: RenderResult):
+        """renders one script into result, recording any error"""
+        try:
+            text = self.translator.render(data)
+        except build_errors() as error:
+            result.errors.append(
+                RenderError(idx, name, f"{type(error).__name__}: {error}")
+            )
+            return
+        if name in result.scripts:
+            result.errors.append(
+                RenderError(idx, name, "duplicate script replaces an earlier one")
+            )
+        result.scripts[name] = text
+
+
+def render(
+    source, context: Optional[ResolutionContext] = None, loader: str = "auto"
+) -> RenderResult:
+    """renders yaml text, parsed data or a list of either in memory
+
+    Returns `{script_name: lua_text}` on `RenderResult.scripts` with any
+    errors on `RenderResult.errors`.  The filesystem is never touched.
+    """
+    return Renderer(context, loader).render(source)
+
+
+class OutputWriter(abc.ABC):
+    """Base class for destinations that rendered scripts are written to
+
+    Writers that can be written to from several threads at once set
+    `thread_safe`; the others are written to from one thread at a time.
+    """
+
+    thread_safe = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @abc.abstractmethod
+    def write(self, name: str, text: str):
+        """writes the text of a rendered script under name"""
+
+    def close(self):
+        """finishes writing"""
+
+
+class DirectoryWriter(OutputWriter):
+    """writes each script to its own file in a directory
+
+    Each script is written to a temporary file that replaces the old one,
+    so a file hard linked to other scripts by a `LinkingWriter` is never
+    overwritten in place.
+    """
+
+    thread_safe = True
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.directories: set[str] = set()
+
+    def write(self, name: str, text: str):
+        directory, _, _ = name.rpartition("/")
+        if directory and directory not in self.directories:
+            (self.path / directory).mkdir(parents=True, exist_ok=True)
+            self.directories.add(directory)
+        target = self.path / name
+        partial = target.with_name(f".{target.name}.{threading.get_ident()}")
+        logger.debug("writing %s", target)
+        with open(partial, "w", encoding="utf-8") as _file:
+            _file.write(text)
+        os.replace(partial, target)
+
+
+class LinkingWriter(DirectoryWriter):
+    """writes each distinct script body once and links scripts to it
+
+    Bodies are stored in `OBJECTS` under the output directory, named by
+    their content hash, and each script's file is a hard link to its
+    body.  Where hard links are not supported, such as across devices,
+    scripts are relative symbolic links instead.  Bodies no script links
+    to are removed by `prune`, unless symbolic links were ever used, since
+    those do not count as links.  Editing a linked file in place edits
+    every script sharing its body, so a stored body is checked against
+    its hash the first time a build uses it and restored if it changed.
+    """
+
+    OBJECTS = ".wrangler-objects"
+    SYMLINKED = ".symlinked"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.objects = self.path / self.OBJECTS
+        self.lock = threading.Lock()
+        self.scripts = 0
+        self.size = 0
+        self.bodies: dict[str, int] = {}
+
+    def write(self, name: str, text: str):
+        body = text.encode("utf-8")
+        digest = hash_bytes(body)
+        directory, _, _ = name.rpartition("/")
+        with self.lock:
+            self.scripts += 1
+            self.size += len(body)
+            first = digest not in self.bodies
+            self.bodies[digest] = len(body)
+            if first:
+                self.objects.mkdir(parents=True, exist_ok=True)
+            if directory and directory not in self.directories:
+                (self.path / directory).mkdir(parents=True, exist_ok=True)
+                self.directories.add(directory)
+        store = self.objects / digest
+        if first and not self.is_stored(store, digest):
+            partial = store.with_name(f"{digest}.{os.getpid()}.{threading.get_ident()}")
+            partial.write_bytes(body)
+            os.replace(partial, store)
+        target = self.path / name
+        try:
+            if os.stat(target).st_ino == os.stat(store).st_ino:
+                return
+        except OSError:
+            pass
+        logger.debug("linking %s to %s", target, digest)
+        partial = target.with_name(f".{target.name}.{threading.get_ident()}")
+        partial.unlink(missing_ok=True)
+        try:
+            os.link(store, partial)
+        except OSError:
+            os.symlink(os.path.relpath(store, partial.parent), partial)
+            (self.objects / self.SYMLINKED).touch()
+        os.replace(partial, target)
+
+    @staticmethod
+    def is_stored(store: Path, digest: str) -> bool:
+        """returns True if store holds the body whose hash is digest"""
+        try:
+            return hash_file(store) == digest
+        except OSError:
+            return False
+
+    def prune(self):
+        """removes the bodies that no script links to any more"""
+        if not self.objects.is_dir() or (self.objects / self.SYMLINKED).exists():
+            return
+        with os.scandir(self.objects) as listing:
+            for entry in listing:
+                if entry.stat().st_nlink == 1 and entry.name not in self.bodies:
+                    logger.debug("removing unlinked body %s", entry.name)
+                    Path(entry.path).unlink(missing_ok=True)
+
+    def report(self) -> dict[str, Any]:
+        """returns how many scripts and bytes were written, how many distinct
+        bodies and bytes they needed and the ratio between the two"""
+        stored = sum(self.bodies.values())
+        return {
+            "scripts": self.scripts,
+            "bodies": len(self.bodies),
+            "bytes": self.size,
+            "stored_bytes": stored,
+            "ratio": self.size / stored if stored else 1.0,
+        }
+
+
+class CollectingWriter(OutputWriter):
+    """keeps rendered scripts in memory so another process can write them"""
+
+    def __init__(self):
+        self.outputs: list[tuple[str, str]] = []
+        self.stats: Optional[Stats] = None
+
+    def write(self, name: str, text: str):
+        self.outputs.append((name, text))
+
+
+class TarWriter(OutputWriter):
+    """writes every script into a single tar archive
+
+    The archive is compressed when the path ends in .gz, .tgz, .bz2 or .xz.
+    """
+
+    COMPRESSION = {".gz": ":gz", ".tgz": ":gz", ".bz2": ":bz2", ".xz": ":xz"}
+
+    def __init__(self, path: Path):
+        mode = "w" + self.COMPRESSION.get(Path(path).suffix, "")
+        self.archive = tarfile.open(path, mode)
+        self.mtime = time.time()
+
+    def write(self, name: str, text: str):
+        data = text.encode("utf-8")
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+
+class ZipWriter(OutputWriter):
+    """writes every script into a single compressed zip archive"""
+
+    def __init__(self, path: Path):
+        self.archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+
+    def write(self, name: str, text: str):
+        self.archive.writestr(name, text)
+
+    def close(self):
+        self.archive.close()
+
+
+class SQLiteWriter(OutputWriter):
+    """writes every script into a SQLite table indexed by name"""
+
+    def __init__(self, path: Path):
+        Path(path).unlink(missing_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE scripts (name TEXT PRIMARY KEY, body TEXT NOT NULL)"
+        )
+
+    def write(self, name: str, text: str):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO scripts (name, body) VALUES (?, ?)", (name, text)
+        )
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+OUTPUT_FORMATS = {
+    "files": DirectoryWriter,
+    "tar": TarWriter,
+    "zip": ZipWriter,
+    "sqlite": SQLiteWriter,
+}
+
+
+class Stats:
+    """accumulates wall and CPU time, scripts and bytes for each build phase
+
+    Phases are timed with laps: `clock` starts one and `lap` charges the
+    time since the previous clock to a phase and starts the next.
+    """
+
+    __slots__ = ("phases", "scripts", "bytes", "files")
+
+    PHASES = ("parse", "translate", "write")
+
+    def __init__(self):
+        self.phases = {name: [0.0, 0.0] for name in self.PHASES}
+        self.scripts = 0
+        self.bytes = 0
+        self.files: list[tuple[float, str]] = []
+
+    @staticmethod
+    def clock() -> tuple[float, float]:
+        """returns the current wall clock and the CPU clock of this thread"""
+        return time.perf_counter(), time.thread_time()
+
+    def lap(self, name: str, start: tuple[float, float]) -> tuple[float, float]:
+        """charges the time since start to the named phase"""
+        now = self.clock()
+        phase = self.phases[name]
+        phase[0] += now[0] - start[0]
+        phase[1] += now[1] - start[1]
+        return now
+
+    def merge(self, other: "Stats"):
+        """adds the totals of other, such as the stats of a worker process"""
+        for name, (wall, cpu) in other.phases.items():
+            self.phases[name][0] += wall
+            self.phases[name][1] += cpu
+        self.scripts += other.scripts
+        self.bytes += other.bytes
+        self.files.extend(other.files)
+
+    def report(self, wall: float, cpu: float, slowest: int = 10) -> dict[str, Any]:
+        """returns the totals as a JSON serializable dict
+
+        wall and cpu are the totals for the whole run.  Phase times are
+        summed over every worker, so with several jobs they can exceed
+        the wall time of the run.
+        """
+        return {
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "files": len(self.files),
+            "scripts": self.scripts,
+            "bytes": self.bytes,
+            "scripts_per_second": self.scripts / wall if wall else 0.0,
+            "bytes_per_second": self.bytes / wall if wall else 0.0,
+            "phases": {
+                name: {"wall_seconds": wall, "cpu_seconds": cpu}
+                for name, (wall, cpu) in self.phases.items()
+            },
+            "slowest_files": [
+                {"path": path, "seconds": seconds}
+                for seconds, path in sorted(self.files, reverse=True)[:slowest]
+            ],
+        }
+
+
+def write_scripts(
+    scripts: Iterable[Script],
+    writer: OutputWriter,
+    stats: Optional[Stats] = None,
+    subtree: bool = False,
+) -> list[str]:
+    """writes Script instances to writer and returns the names written
+
+    Scripts are written as they are iterated, so a generator of scripts
+    is never held in memory.  With stats, the time spent producing each
+    script is charged to parsing, then rendering and writing are timed.
+    With subtree, each script is written under its target's directory.
+    Each name is returned once, even when a later script replaced it.
+    """
+    names = []
+    if stats is None:
+        for script in scripts:
+            filename = script.translator.filename(script.name, subtree)
+            writer.write(filename, script.text)
+            names.append(script.name)
+        return list(dict.fromkeys(names))
+    clock = stats.clock()
+    for script in scripts:
+        clock = stats.lap("parse", clock)
+        text = script.text
+        clock = stats.lap("translate", clock)
+        writer.write(script.translator.filename(script.name, subtree), text)
+        clock = stats.lap("write", clock)
+        stats.scripts += 1
+        stats.bytes += len(text.encode("utf-8"))
+        names.append(script.name)
+    return list(dict.fromkeys(names))
+
+
+def write_scripts_to_files(scripts: Iterable[Script], output_path: Path) -> list[str]:
+    """writes Script instances to files at output path"""
+    return write_scripts(scripts, DirectoryWriter(output_path))
+
+
+def read_bundle(bundle: Path) -> Generator[tuple[str, bytes], None, None]:
+    """yields the name and content of every script in a bundle"""
+    with open(bundle, "rb") as _file:
+        is_sqlite = _file.read(16) == b"SQLite format 3\x00"
+    if is_sqlite:
+        connection = sqlite3.connect(f"file:{bundle}?mode=ro", uri=True)
+        try:
+            for name, body in connection.execute("SELECT name, body FROM scripts"):
+                yield name, body.encode("utf-8")
+        finally:
+            connection.close()
+    elif zipfile.is_zipfile(bundle):
+        with zipfile.ZipFile(bundle) as archive:
+            for name in archive.namelist():
+                yield name, archive.read(name)
+    elif tarfile.is_tarfile(bundle):
+        with tarfile.open(bundle) as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"{bundle} is not a tar, zip or sqlite bundle")
+
+
+def extract_bundle(bundle: Path, output_path: Path) -> int:
+    """materializes the scripts in a bundle under output_path
+
+    Returns the number of scripts extracted.
+    """
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for name, body in read_bundle(bundle):
+        relative = Path(name)
+        if relative.is_absolute() or ".." in relative.parts:
+            raise ValueError(f"refusing to extract '{name}' outside the output path")
+        target = output_path / relative
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(body)
+        count += 1
+    return count
+
+
+class BuildResult:
+    """represents the outcome of building a single input file"""
+
+    __slots__ = (
+        "path",
+        "scripts",
+        "error",
+        "digest",
+        "environment",
+        "references",
+        "skipped",
+        "outputs",
+        "stats",
+        "other_shards",
+        "saved",
+        "modules",
+    )
+
+    def __init__(self, path: Path, scripts=(), error: Optional[str] = None):
+        self.path = path
+        self.scripts = list(scripts)
+        self.error = error
+        self.digest: Optional[str] = None
+        self.environment: dict[str, Optional[str]] = {}
+        self.references: dict[str, list[str]] = {}
+        self.skipped = False
+        self.outputs: list[tuple[str, str]] = []
+        self.other_shards: list[str] = []
+        self.saved = (0, 0)
+        self.modules: list[dict[str, Any]] = []
+
+    @property
+    def ok(self) -> bool:
+        """returns True if the file was built without error"""
+        return self.error is None
+
+    def as_dict(self) -> dict[str, Any]:
+        """returns the result as a JSON serializable dict"""
+        return {
+            "path": str(self.path),
+            "scripts": self.scripts,
+            "error": self.error,
+            "skipped": self.skipped,
+        }
+
+
+class BuildOptions:
+    """represents the settings shared by every file in a build"""
+
+    __slots__ = (
+        "output_path",
+        "loader",
+        "stream",
+        "output_format",
+        "context",
+        "stats",
+        "targets",
+        "data_cache",
+        "shard",
+        "library",
+        "imported",
+        "optimize",
+        "spider_cache",
+        "dedup",
+    )
+
+    def __init__(
+        self,
+        output_path: Path,
+        loader: str = "auto",
+        stream: bool = False,
+        output_format: str = "files",
+        context: Optional[ResolutionContext] = None,
+        stats: bool = False,
+        targets: Iterable[str] = ("lua",),
+        data_cache: Optional[DataCache] = None,
+        shard: Optional[tuple[int, int]] = None,
+        library: Optional[FragmentLibrary] = None,
+        optimize: bool = False,
+        spider_cache: Optional[Path] = None,
+        dedup: bool = False,
+    ):
+        self.output_path = output_path
+        self.loader = loader
+        self.stream = stream
+        self.output_format = output_format
+        self.context = context or ResolutionContext.from_sources()
+        self.stats = stats
+        self.targets = tuple(targets)
+        self.data_cache = data_cache
+        self.shard = shard
+        self.library = library
+        self.imported: dict[tuple[str, str], tuple[list[str], dict, dict]] = {}
+        self.optimize = optimize
+        self.spider_cache = spider_cache
+        self.dedup = dedup
+
+    @property
+    def subtree(self) -> bool:
+        """returns True if each target is written to its own subdirectory"""
+        return len(self.targets) > 1
+
+    def writer(self) -> OutputWriter:
+        """returns a writer for output_path in the build's output format"""
+        if self.dedup:
+            return LinkingWriter(self.output_path)
+        return OUTPUT_FORMATS[self.output_format](self.output_path)
+
+    def translators(self) -> list[Translator]:
+        """returns a translator for each target, sharing the build's library
+        and the fragments translated from it"""
+        translators = [TARGETS[target](self.context) for target in self.targets]
+        for translator in translators:
+            translator.library = self.library
+            translator.imported = self.imported
+            translator.optimize = self.optimize
+        return translators
+
+
+def hash_bytes(content: bytes) -> str:
+    """returns the hex digest used to identify input content"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def hash_file(path: Path, chunk_size: int = 1 << 20) -> str:
+    """returns the hex digest of a file, reading it in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as _file:
+        for chunk in iter(lambda: _file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """keeps parsed inputs warm between builds in a long-running process
+
+    Entries are keyed by path and loader and reused while the file's
+    modification time and size are unchanged, so only edited inputs are
+    parsed again.  Parsed data is shared by every caller and must not be
+    mutated.
+    """
+
+    def __init__(self):
+        self.entries: dict[tuple[str, str], tuple[tuple[int, int], str, Any]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path: Path, loader: str = "auto") -> tuple[str, Any]:
+        """returns the digest and parsed data of path, parsing it if needed"""
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = (str(Path(path).resolve()), loader)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        content = Path(path).read_bytes()
+        digest = hash_bytes(content)
+        data = yaml.load(content.decode("utf-8"), Loader=document_loader(loader))
+        with self.lock:
+            self.entries[key] = (stamp, digest, data)
+        return digest, data
+
+
+class DataCache:
+    """keeps the parsed, merge-resolved data of inputs on disk between runs
+
+    Entries are stored with `marshal` and keyed by the input's content
+    hash, the loader, the Python version and the wrangler version, so a
+    run whose inputs are unchanged skips YAML parsing even when its
+    variables have changed.  Objects shared by several scripts, such as
+    merged anchors, are still shared when an entry is loaded.
+
+    Each hit refreshes the entry's modification time, and `prune` evicts
+    the least recently used entries once the cache holds more than
+    `limit` bytes.  Inputs holding values marshal cannot store, such as
+    timestamps, are parsed every time.
+    """
+
+    SUFFIX = ".marshal"
+
+    def __init__(self, path: Path, limit: int = 256 << 20):
+        self.path = Path(path)
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, digest: str, loader: str) -> Path:
+        """returns the file holding the data of an input's content"""
+        version = f"{wrangler_version()}:{sys.version_info[:2]}:{loader}:{digest}"
+        return self.path / f"{hash_bytes(version.encode('utf-8'))}{self.SUFFIX}"
+
+    def load(self, path: Path, loader: str = "auto") -> tuple[str, Any]:
+        """returns the digest and parsed data of path, parsing it on a miss"""
+        content = Path(path).read_bytes()
+        digest = hash_bytes(content)
+        entry = self.entry(digest, loader)
+        try:
+            data = marshal.loads(entry.read_bytes())
+            os.utime(entry)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            self.hits += 1
+            return digest, data
+        self.misses += 1
+        data = yaml.load(content.decode("utf-8"), Loader=document_loader(loader))
+        self.store(entry, data)
+        return digest, data
+
+    def store(self, entry: Path, data: Any):
+        """writes an entry atomically, skipping data marshal cannot store"""
+        try:
+            body = marshal.dumps(data)
+        except ValueError:
+            return
+        partial = entry.with_name(f"{entry.name}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            partial.write_bytes(body)
+            os.replace(partial, entry)
+        except OSError as error:
+            logger.debug("unable to cache %s (%s)", entry, error)
+            partial.unlink(missing_ok=True)
+
+    def prune(self):
+        """evicts the least recently used entries until the cache fits its limit"""
+        entries = []
+        try:
+            with os.scandir(self.path) as listing:
+                for entry in listing:
+                    if entry.name.endswith(self.SUFFIX):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except OSError:
+            return
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_path in sorted(entries):
+            if size <= self.limit:
+                break
+            logger.debug("evicting cached data %s", entry_path)
+            Path(entry_path).unlink(missing_ok=True)
+            size -= entry_size
+
+
+class FragmentLibrary:
+    """shared fragments that stack files include by name
+
+    Each library file maps fragment names to lists of content items,
+    such as the `^pre` and `^post` templates many stack files repeat,
+    and scripts include them with `- include: pre`.  Files are parsed
+    when the library is created and again by `refresh` only once their
+    modification time or size changes, so a server keeps its library
+    warm across requests.  Fragment names must be unique across files.
+    """
+
+    def __init__(self, paths: Iterable[Path], loader: str = "auto"):
+        self.paths = [Path(path) for path in paths]
+        self.loader = loader
+        self.stamps: dict[str, tuple[int, int]] = {}
+        self.files: dict[str, dict[str, list[dict[str, Any]]]] = {}
+        self.fragments: dict[str, tuple[list[dict[str, Any]], str]] = {}
+        self.refresh()
+
+    def refresh(self) -> list[str]:
+        """reparses the library files that changed and returns them"""
+        changed = []
+        for path in self.paths:
+            key = str(path.resolve())
+            stat = os.stat(key)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if self.stamps.get(key) != stamp:
+                self.files[key] = self.parse(key)
+                self.stamps[key] = stamp
+                changed.append(key)
+        if changed:
+            fragments: dict[str, tuple[list[dict[str, Any]], str]] = {}
+            for key, names in self.files.items():
+                for name, items in names.items():
+                    if name in fragments:
+                        raise ValueError(
+                            f"fragment '{name}' is defined by {fragments[name][1]} "
+                            f"and {key}"
+                        )
+                    fragments[name] = (items, key)
+            self.fragments = fragments
+        return changed
+
+    def parse(self, path: str) -> dict[str, list[dict[str, Any]]]:
+        """returns the fragments of a library file by name"""
+        with open(path, "r", encoding="utf-8") as _file:
+            data = yaml.load(_file, Loader=document_loader(self.loader))
+        if not isinstance(data, dict):
+            raise ValueError(f"{path} does not map fragment names to content")
+        fragments = {}
+        for name, items in data.items():
+            if "^" in str(name):
+                continue
+            items = items if isinstance(items, list) else [items]
+            if not all(isinstance(item, dict) for item in items):
+                raise ValueError(f"fragment '{name}' in {path} is not content items")
+            fragments[str(name)] = items
+        return fragments
+
+    def fragment(self, name: str) -> tuple[list[dict[str, Any]], str]:
+        """returns the content items of a fragment and the file defining it"""
+        try:
+            return self.fragments[name]
+        except KeyError:
+            raise ValueError(f"unknown fragment '{name}'") from None
+
+    def dependents(
+        self, results: Iterable[BuildResult], changed: Iterable[str]
+    ) -> list[Path]:
+        """returns the inputs whose scripts include a fragment of a changed file"""
+        changed = set(changed)
+        return [
+            result.path
+            for result in results
+            if changed.intersection(result.references.get("library", ()))
+        ]
+
+
+def build_file(
+    path: Path,
+    options: BuildOptions,
+    writer: Optional[OutputWriter] = None,
+    cache: Optional[ParseCache] = None,
+) -> BuildResult:
+    """parses, translates and writes a single file, capturing any error
+
+    Scripts are written to writer when one is given.  Otherwise they are
+    written to the output directory for the "files" format, or collected
+    on the result so the parent process can add them to a bundle.
+
+    In stream mode each script is written as soon as its top-level key
+    has been parsed, so memory is bounded by the largest script rather
+    than by the size of the file.  Otherwise parsed data is taken from
+    cache when one is given, or from the options' data cache.
+
+    The file is parsed once with the first target's translator, which
+    records the variables and references of every target.  With a shard,
+    only that shard's scripts are rendered and the names of the others
+    are recorded on the result.
+    """
+    logger.debug("building %s", path)
+    if writer is None:
+        if options.output_format == "files":
+            writer = options.writer()
+        else:
+            writer = CollectingWriter()
+    stats = Stats() if options.stats else None
+    start = time.perf_counter()
+    translators = options.translators()
+    translator = translators[0]
+    others: list[str] = []
+    modules = [] if options.spider_cache is not None else None
+    try:
+        if options.stream:
+            digest = hash_file(path)
+            with open(path, "r", encoding="utf-8") as _file:
+                scripts = stream_scripts(_file, translator, options.loader)
+                names = write_scripts(
+                    retarget(
+                        describe_scripts(
+                            select_shard(scripts, options.shard, others), modules
+                        ),
+                        translators,
+                    ),
+                    writer,
+                    stats,
+                    options.subtree,
+                )
+        else:
+            clock = Stats.clock()
+            cache = cache or options.data_cache
+            if cache is not None:
+                digest, data = cache.load(path, options.loader)
+                scripts = scripts_from_data(data, translator)
+            else:
+                content = Path(path).read_bytes()
+                digest = hash_bytes(content)
+                scripts = parse_scripts(
+                    content.decode("utf-8"), translator, options.loader
+                )
+            if stats is not None:
+                stats.lap("parse", clock)
+            names = write_scripts(
+                retarget(
+                    describe_scripts(
+                        select_shard(scripts, options.shard, others), modules
+                    ),
+                    translators,
+                ),
+                writer,
+                stats,
+                options.subtree,
+            )
+    except build_errors() as error:
+        result = BuildResult(path, error=f"{type(error).__name__}: {error}")
+    else:
+        result = BuildResult(path, names)
+        result.other_shards = others
+        result.saved = total_saved(translators)
+        result.modules = modules or []
+        result.digest = digest
+        result.environment = translator.resolved
+        result.references = {
+            kind: sorted(names) for kind, names in translator.references.items()
+        }
+    if isinstance(writer, CollectingWriter):
+        result.outputs = writer.outputs
+    if stats is not None:
+        stats.files.append((time.perf_counter() - start, str(path)))
+        result.stats = stats
+    return result
+
+
+def collect_file(path: Path, options: BuildOptions) -> BuildResult:
+    """builds a single file, returning its rendered scripts on the result
+
+    Process pool workers collect their output so the parent writes every
+    file in input order, and a script defined by several inputs is won
+    by the last one as it is in a serial build.
+    """
+    return build_file(path, options, CollectingWriter())
+
+
+class Pipeline:
+    """builds files through overlapping parse, translate and write stages
+
+    A parser thread feeds scripts through a bounded queue to the calling
+    thread, which renders them and hands the text to a pool of I/O
+    threads.  The bounded queue and a cap on writes in flight keep memory
+    bounded while parsing, translation and slow filesystem writes overlap.
+    Results, and the first error of each file, match a serial build, and
+    an error that would abort a serial build is raised by `run` too.
+    """
+
+    def __init__(
+        self,
+        options: BuildOptions,
+        writer: OutputWriter,
+        io_threads: int = 4,
+        depth: int = 64,
+    ):
+        self.options = options
+        self.writer = writer
+        self.io_threads = io_threads if writer.thread_safe else 1
+        self.depth = depth
+        self.error: Optional[BaseException] = None
+
+    def run(self, paths: list[Path]) -> list[BuildResult]:
+        """builds every path and returns the results in input order"""
+        handoff: Queue = Queue(maxsize=self.depth)
+        parser = threading.Thread(
+            target=self.parse, args=(paths, handoff), name="wrangler-parse"
+        )
+        parser.daemon = True
+        parser.start()
+        in_flight = threading.BoundedSemaphore(self.depth)
+        files: list[dict[str, Any]] = [
+            {"names": [], "writes": [], "modules": [], "error": None, "stats": None}
+            for _ in paths
+        ]
+        with futures.ThreadPoolExecutor(self.io_threads, "wrangler-io") as executor:
+            for idx, item in iter(handoff.get, None):
+                state = files[idx]
+                if isinstance(item, Script):
+                    if state["error"] is None:
+                        self.translate(item, state, executor, in_flight)
+                else:
+                    state.update(item)
+            parser.join()
+            if self.error is not None:
+                raise self.error
+            results = [self.result(path, state) for path, state in zip(paths, files)]
+        return results
+
+    def parse(self, paths: list[Path], handoff: Queue):
+        """parses each path in turn, handing off scripts as they are produced
+
+        The end of input is always handed off, and an error that is not a
+        build error is kept in `error` for `run` to raise.
+        """
+        try:
+            self.parse_paths(paths, handoff)
+        except BaseException as error:
+            self.error = error
+        finally:
+            handoff.put(None)
+
+    def parse_paths(self, paths: list[Path], handoff: Queue):
+        """parses each path in turn, handing off scripts and file results"""
+        options = self.options
+        for idx, path in enumerate(paths):
+            logger.debug("building %s", path)
+            stats = Stats() if options.stats else None
+            translators = options.translators()
+            translator = translators[0]
+            handoff.put((idx, {"start": time.perf_counter(), "stats": stats}))
+            parsed: dict[str, Any] = {"other_shards": []}
+            try:
+                clock = Stats.clock()
+                if options.stream:
+                    parsed["digest"] = hash_file(path)
+                    with open(path, "r", encoding="utf-8") as _file:
+                        scripts = stream_scripts(_file, translator, options.loader)
+                        for script in retarget(
+                            select_shard(
+                                scripts, options.shard, parsed["other_shards"]
+                            ),
+                            translators,
+                        ):
+                            if stats is not None:
+                                stats.lap("parse", clock)
+                            handoff.put((idx, script))
+                            clock = Stats.clock()
+                else:
+                    if options.data_cache is not None:
+                        parsed["digest"], data = options.data_cache.load(
+                            path, options.loader
+                        )
+                        scripts = scripts_from_data(data, translator)
+                    else:
+                        content = Path(path).read_bytes()
+                        parsed["digest"] = hash_bytes(content)
+                        scripts = parse_scripts(
+                            content.decode("utf-8"), translator, options.loader
+                        )
+                    if stats is not None:
+                        stats.lap("parse", clock)
+                    for script in retarget(
+                        select_shard(scripts, options.shard, parsed["other_shards"]),
+                        translators,
+                    ):
+                        handoff.put((idx, script))
+                parsed["environment"] = translator.resolved
+                parsed["references"] = translator.references
+                parsed["translators"] = translators
+            except build_errors() as error:
+                parsed["parse_error"] = f"{type(error).__name__}: {error}"
+            handoff.put((idx, parsed))
+
+    def translate(self, script: Script, state: dict, executor, in_flight):
+        """renders a script and queues its text to be written"""
+        stats = state["stats"]
+        clock = Stats.clock()
+        try:
+            text = script.text
+        except build_errors() as error:
+            state["error"] = f"{type(error).__name__}: {error}"
+            return
+        if stats is not None:
+            stats.lap("translate", clock)
+            stats.scripts += 1
+            stats.bytes += len(text.encode("utf-8"))
+        options = self.options
+        if (
+            options.spider_cache is not None
+            and script.translator.target == options.targets[0]
+        ):
+            state["modules"].append(spider_entry(script))
+        in_flight.acquire()
+        filename = script.translator.filename(script.name, self.options.subtree)
+        future = executor.submit(self.write, filename, text)
+        future.add_done_callback(lambda _: in_flight.release())
+        state["writes"].append(future)
+        state["names"].append(script.name)
+
+    def write(self, name: str, text: str) -> tuple[float, float, float]:
+        """writes one script, returning the wall and CPU time taken and when"""
+        wall, cpu = Stats.clock()
+        self.writer.write(name, text)
+        end_wall, end_cpu = Stats.clock()
+        return end_wall - wall, end_cpu - cpu, end_wall
+
+    def result(self, path: Path, state: dict[str, Any]) -> BuildResult:
+        """waits for the writes of a file and returns its build result"""
+        stats, finished = state["stats"], state.get("start", 0.0)
+        error = state["error"]
+        for future in state["writes"]:
+            try:
+                wall, cpu, finished = future.result()
+            except OSError as write_error:
+                error = error or f"{type(write_error).__name__}: {write_error}"
+                continue
+            if stats is not None:
+                stats.phases["write"][0] += wall
+                stats.phases["write"][1] += cpu
+        error = error or state.get("parse_error")
+        if error is not None:
+            result = BuildResult(path, error=error)
+        else:
+            result = BuildResult(path, list(dict.fromkeys(state["names"])))
+            result.other_shards = state["other_shards"]
+            result.saved = total_saved(state["translators"])
+            result.modules = state["modules"]
+            result.digest = state["digest"]
+            result.environment = state["environment"]
+            result.references = {
+                kind: sorted(names) for kind, names in state["references"].items()
+            }
+        if stats is not None:
+            stats.files.append((max(finished - state["start"], 0.0), str(path)))
+            result.stats = stats
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def wrangler_version() -> str:
+    """returns a digest identifying the code that rendered an output
+
+    It is a hash of this module's source, so output built by an edited
+    or upgraded wrangler is never mistaken for current.
+    """
+    return hash_file(Path(__file__))
+
+
+class Manifest:
+    """maps each input to its content hash, resolved environment and scripts
+
+    The manifest is stored in the output directory and lets incremental
+    builds skip inputs whose content, environment, loader and wrangler
+    version are unchanged and whose outputs still exist, and prune the
+    outputs of inputs or scripts that no longer exist.
+
+    Stale outputs are only removed by `remove_stale`, once every result
+    of a build has been recorded, so a script that moved to another input
+    is kept.
+
+    The digest of every library file an input included fragments from is
+    recorded too, so editing a shared fragment rebuilds all dependents.
+    """
+
+    FILENAME = ".wrangler-manifest.json"
+
+    def __init__(
+        self,
+        output_path: Path,
+        targets: Iterable[str] = ("lua",),
+        loader: str = "auto",
+    ):
+        self.output_path = Path(output_path)
+        self.targets = list(targets)
+        self.loader = loader
+        self.path = self.output_path / self.FILENAME
+        self.entries: dict[str, dict[str, Any]] = {}
+        self.stale: set[str] = set()
+        self.digests: dict[str, Optional[str]] = {}
+        if self.path.exists():
+            try:
+                self.entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except ValueError:
+                logger.warning("ignoring unreadable manifest %s", self.path)
+
+    @staticmethod
+    def key(path: Path) -> str:
+        """returns the manifest key for an input path"""
+        return str(Path(path).resolve())
+
+    def is_current(self, path: Path, context: ResolutionContext) -> bool:
+        """returns True if path and the variables it resolved are unchanged
+        and its outputs were built by this wrangler and still exist"""
+        entry = self.entries.get(self.key(path))
+        if entry is None or entry["hash"] is None:
+            return False
+        if (
+            entry.get("targets", ["lua"]) != self.targets
+            or entry.get("loader") != self.loader
+            or entry.get("version") != wrangler_version()
+        ):
+            return False
+        if not all((self.output_path / name).exists() for name in self.files(entry)):
+            return False
+        try:
+            if hash_file(path) != entry["hash"]:
+                return False
+        except OSError:
+            return False
+        if any(
+            self.library_digest(library) != digest
+            for library, digest in entry.get("libraries", {}).items()
+        ):
+            return False
+        return all(
+            context.values.get(name) == value
+            for name, value in entry["environment"].items()
+        )
+
+    def library_digest(self, path: str) -> Optional[str]:
+        """returns the digest of a library file, hashing it once per build"""
+        if path not in self.digests:
             try:
-                yield [
-                    Script(script_name, data, translator)
-                    for (script_name, data) in yaml.safe_load(_file).items()
-                    if "^" not in script_name
-                ]
-            except (AttributeError, yaml.parser.ParserError) as error:
-                logging.error(
-                    "Invalid YAML file detected. [CTRL-C] to quit. (%s)", str(error)
+                self.digests[path] = hash_file(Path(path))
+            except OSError:
+                self.digests[path] = None
+        return self.digests[path]
+
+    def changed_libraries(self) -> dict[str, list[str]]:
+        """returns each library file changed since it was recorded, with the
+        inputs that include its fragments"""
+        changed: dict[str, list[str]] = {}
+        for key, entry in self.entries.items():
+            for library, digest in entry.get("libraries", {}).items():
+                if self.library_digest(library) != digest:
+                    changed.setdefault(library, []).append(key)
+        return changed
+
+    def update(self, result: BuildResult):
+        """records a build result, marking scripts the input no longer defines
+        as stale"""
+        if result.skipped:
+            return
+        key = self.key(result.path)
+        previous = self.entries.get(key)
+        if not result.ok:
+            if previous is not None:
+                previous["hash"] = None
+            return
+        entry = {
+            "hash": result.digest,
+            "environment": result.environment,
+            "references": result.references,
+            "libraries": {
+                library: self.library_digest(library)
+                for library in result.references.get("library", ())
+            },
+            "scripts": result.scripts,
+            "modules": result.modules,
+            "targets": self.targets,
+            "loader": self.loader,
+            "version": wrangler_version(),
+        }
+        if previous is not None:
+            self.stale.update(self.files(previous) - self.files(entry))
+        self.entries[key] = entry
+
+    def prune(self):
+        """forgets inputs that no longer exist, marking their outputs as stale"""
+        for key in [key for key in self.entries if not Path(key).exists()]:
+            logger.info("pruning outputs of deleted input %s", key)
+            self.stale.update(self.files(self.entries.pop(key)))
+
+    @staticmethod
+    def files(entry: dict[str, Any]) -> set[str]:
+        """returns the output files of an entry's scripts for each of its targets"""
+        targets = [TARGETS[target] for target in entry.get("targets", ["lua"])]
+        return {
+            translator.filename(name, len(targets) > 1)
+            for translator in targets
+            for name in entry["scripts"]
+        }
+
+    def remove_stale(self):
+        """deletes stale output files that no recorded input produces"""
+        files = self.stale
+        for entry in self.entries.values():
+            files.difference_update(self.files(entry))
+        for filename in sorted(files):
+            logger.debug("removing stale script %s", filename)
+            Path(self.output_path / filename).unlink(missing_ok=True)
+        self.stale = set()
+
+    def save(self):
+        """writes the manifest to the output directory"""
+        self.path.write_text(
+            json.dumps(self.entries, indent=2, sort_keys=True), encoding="utf-8"
+        )
+
+
+def build(
+    paths: Iterable[Path],
+    output_path: Path,
+    *,
+    jobs: int = 1,
+    incremental: bool = False,
+    loader: str = "auto",
+    stream: bool = False,
+    output_format: str = "files",
+    context: Optional[ResolutionContext] = None,
+    stats: Optional[Stats] = None,
+    io_threads: int = 0,
+    cache: Optional[ParseCache] = None,
+    targets: Iterable[str] = ("lua",),
+    data_cache: Optional[DataCache] = None,
+    shard: Optional[tuple[int, int]] = None,
+    library: Optional[FragmentLibrary] = None,
+    optimize: bool = False,
+    spider_cache: Optional[Path] = None,
+    dedup: bool = False,
+) -> list[BuildResult]:
+    """builds every path and returns the results in input order
+
+    Every option after output_path must be passed by keyword.  With more than one job, files are fanned out across a process pool.
+    Results are still collected and written in input order so the output
+    and the order errors are reported in match the serial path.  Scripts
+    defined by more than one input are reported, and the last input wins.
+    Incremental builds skip inputs the manifest in output_path records as
+    current.
+
+    For bundle output formats output_path is the bundle file.  Workers
+    return their rendered scripts and the bundle is written here.
+
+    Variables are resolved from context, which defaults to a snapshot of
+    the environment taken once for the whole run.  When stats is given,
+    the per-phase totals of every file built are added to it.
+
+    A serial build with io_threads runs through a `Pipeline` so parsing,
+    translation and writes overlap.  Other serial builds take parsed
+    inputs from cache when one is given.  Unstreamed builds take parsed
+    inputs from data_cache, which is pruned to its size limit afterwards.
+
+    Each input is parsed once and rendered for every target.  With
+    several targets each one is written to its own subdirectory, such as
+    `lua/` and `tcl/`.
+
+    With shard, a (K, N) pair, every input is parsed but only the scripts
+    of shard K are written, and a shard manifest recording them is saved
+    to output_path for `merge_shards` to check.
+
+    Scripts include fragments from library, each translated once for the
+    whole build.  Incremental builds report every library file changed
+    since the last build along with the inputs rebuilt because of it.
+
+    With optimize, redundant commands are removed from every script with
+    `Translator.minimize` and the lines and bytes saved are logged.
+
+    With spider_cache, an Lmod spider cache of every script written for
+    the first target is saved to that directory with `write_spider_cache`.
+
+    With dedup, scripts are written through a `LinkingWriter`, so each
+    distinct body is stored once, bodies no script links to any more are
+    pruned once stale scripts are removed, and the deduplication ratio is
+    logged.
+    """
+    if incremental and output_format != "files":
+        raise ValueError("incremental builds require the 'files' output format")
+    if shard is not None and (incremental or output_format != "files"):
+        raise ValueError("sharded builds require non-incremental 'files' output")
+    if spider_cache is not None and (shard is not None or output_format != "files"):
+        raise ValueError("spider caches require unsharded 'files' output")
+    if dedup and output_format != "files":
+        raise ValueError("deduplicated builds require the 'files' output format")
+    options = BuildOptions(
+        output_path,
+        loader,
+        stream,
+        output_format,
+        context,
+        stats is not None,
+        targets,
+        data_cache,
+        shard,
+        library,
+        optimize,
+        spider_cache,
+        dedup,
+    )
+    paths = list(paths)
+    results: list[Optional[BuildResult]] = [None] * len(paths)
+    manifest = Manifest(output_path, options.targets, loader) if incremental else None
+    if manifest is not None:
+        manifest.prune()
+        for library_file, dependents in manifest.changed_libraries().items():
+            logger.info(
+                "%s changed, rebuilding %d dependents: %s",
+                library_file,
+                len(dependents),
+                ", ".join(dependents),
+            )
+        for idx, path in enumerate(paths):
+            if manifest.is_current(path, options.context):
+                entry = manifest.entries[manifest.key(path)]
+                result = results[idx] = BuildResult(path, entry["scripts"])
+                result.environment = entry["environment"]
+                result.references = entry.get("references", {})
+                result.modules = entry.get("modules", [])
+                result.skipped = True
+        logger.info("skipping %d unchanged files", len(paths) - results.count(None))
+
+    pending = [idx for idx, result in enumerate(results) if result is None]
+    todo = [paths[idx] for idx in pending]
+    with options.writer() as writer:
+        if jobs > 1 and len(todo) > 1:
+            chunksize = max(1, len(todo) // (jobs * 4))
+            with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                built = []
+                for result in executor.map(
+                    collect_file, todo, itertools.repeat(options), chunksize=chunksize
+                ):
+                    for name, text in result.outputs:
+                        writer.write(name, text)
+                    result.outputs = []
+                    built.append(result)
+        elif io_threads > 0:
+            built = Pipeline(options, writer, io_threads).run(todo)
+        else:
+            built = [build_file(path, options, writer, cache) for path in todo]
+    for idx, result in zip(pending, built):
+        results[idx] = result
+
+    for result in built:
+        if stats is not None and result.stats is not None:
+            stats.merge(result.stats)
+            result.stats = None
+        if not result.ok:
+            logger.error("failed to build %s (%s)", result.path, result.error)
+        if manifest is not None:
+            manifest.update(result)
+    if manifest is not None:
+        manifest.remove_stale()
+        manifest.save()
+    if isinstance(writer, LinkingWriter):
+        writer.prune()
+    if data_cache is not None:
+        data_cache.prune()
+    if shard is not None:
+        write_shard_manifest(output_path, shard, results)
+    if isinstance(writer, LinkingWriter):
+        report = writer.report()
+        logger.info(
+            "wrote %d scripts as %d distinct files, storing %d of %d bytes "
+            "(dedup ratio %.2f)",
+            report["scripts"],
+            report["bodies"],
+            report["stored_bytes"],
+            report["bytes"],
+            report["ratio"],
+        )
+    if spider_cache is not None:
+        count = write_spider_cache(
+            spider_cache,
+            output_path,
+            results,
+            TARGETS[options.targets[0]],
+            options.subtree,
+        )
+        logger.info("wrote a spider cache of %d modules to %s", count, spider_cache)
+
+    for name, owners in duplicate_scripts(results).items():
+        logger.warning(
+            "script %s is defined by %s; using %s", name, ", ".join(owners), owners[-1]
+        )
+    unresolved = unresolved_variables(results)
+    if unresolved:
+        logger.warning(
+            "%d unresolved variables: %s", len(unresolved), ", ".join(unresolved)
+        )
+    if optimize:
+        lines, size = total_saved(results)
+        logger.info("optimizing saved %d lines (%d bytes)", lines, size)
+    return results
+
+
+def total_saved(items: Iterable[Any]) -> tuple[int, int]:
+    """returns the lines and bytes the optimizer removed, summed over the
+    `saved` counts of translators or build results"""
+    saved = [item.saved for item in items]
+    return sum(lines for lines, _ in saved), sum(size for _, size in saved)
+
+
+def shard_manifest_name(shard: tuple[int, int]) -> str:
+    """returns the file name of the manifest of shard K of N"""
+    return f".wrangler-shard-{shard[0]}-of-{shard[1]}.json"
+
+
+def write_shard_manifest(
+    output_path: Path, shard: tuple[int, int], results: Iterable[BuildResult]
+) -> Path:
+    """records the scripts a shard built from each input, and the scripts it
+    left to other shards, in output_path"""
+    path = Path(output_path) / shard_manifest_name(shard)
+    manifest = {
+        "shard": shard[0],
+        "count": shard[1],
+        "inputs": {
+            str(result.path): {
+                "scripts": result.scripts,
+                "other_shards": result.other_shards,
+                "error": result.error,
+            }
+            for result in results
+        },
+    }
+    path.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    return path
+
+
+def merge_shards(manifests: Iterable[dict[str, Any]]) -> list[str]:
+    """checks the manifests of every shard of a build, returning its problems
+
+    Every shard must be present once, every input must have been built
+    by every shard, and every script must have been produced by exactly
+    one shard.  Script names defined by more than one input are flagged
+    too, since only one of them can be installed.
+    """
+    problems = []
+    manifests = list(manifests)
+    counts = {manifest["count"] for manifest in manifests}
+    if len(counts) != 1:
+        return [f"shard manifests disagree on the shard count ({sorted(counts)})"]
+    (count,) = counts
+    shards = [manifest["shard"] for manifest in manifests]
+    for index in range(1, count + 1):
+        if shards.count(index) != 1:
+            problems.append(
+                f"shard {index}/{count} has {shards.count(index)} manifests"
+            )
+    inputs = set().union(*(manifest["inputs"] for manifest in manifests))
+    defined: dict[str, set[str]] = {}
+    produced: dict[str, set[int]] = {}
+    for manifest in manifests:
+        for path in sorted(inputs - set(manifest["inputs"])):
+            problems.append(f"{path}: not built by shard {manifest['shard']}")
+        for path, entry in manifest["inputs"].items():
+            if entry["error"] is not None:
+                problems.append(
+                    f"{path}: failed on shard {manifest['shard']} ({entry['error']})"
                 )
+            for name in entry["scripts"]:
+                produced.setdefault(name, set()).add(manifest["shard"])
+            for name in entry["scripts"] + entry["other_shards"]:
+                defined.setdefault(name, set()).add(path)
+    for name in sorted(defined):
+        shards_built = produced.get(name, set())
+        if len(shards_built) != 1:
+            listed = ", ".join(map(str, sorted(shards_built))) or "none"
+            problems.append(f"script {name} was produced by shards: {listed}")
+        if len(defined[name]) > 1:
+            listed = ", ".join(sorted(defined[name]))
+            problems.append(f"script {name} is defined by several inputs: {listed}")
+    return problems
 
 
-def write_scripts_to_files(scripts: list[Script], output_path: Path):
-    """writes a list of Script instances to files at output path"""
-    for script in scripts:
-        with open(
-            Path(output_path / f"{script.name}.lua"), "w", encoding="utf-8"
-        ) as _file:
-            logger.debug("writing %s", _file.name)
-            _file.writelines(
-                itertools.chain(script.help, script.content, script.whatis)
+def unresolved_variables(results: Iterable[BuildResult]) -> dict[str, list[str]]:
+    """maps each variable that could not be resolved to the inputs using it"""
+    unresolved: dict[str, list[str]] = {}
+    for result in results:
+        for name, value in result.environment.items():
+            if value is None:
+                unresolved.setdefault(name, []).append(str(result.path))
+    return dict(sorted(unresolved.items()))
+
+
+def duplicate_scripts(results: Iterable[BuildResult]) -> dict[str, list[str]]:
+    """maps each script defined by more than one input to those inputs"""
+    owners: dict[str, list[str]] = {}
+    for result in results:
+        for name in result.scripts:
+            owners.setdefault(name, []).append(str(result.path))
+    return {name: paths for name, paths in owners.items() if len(paths) > 1}
+
+
+def cache_home() -> Path:
+    """returns the directory wrangler keeps its caches in"""
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache) / "wrangler"
+
+
+def default_module_index() -> Path:
+    """returns the default location of the persisted module index"""
+    return cache_home() / "modules.json"
+
+
+class ModuleIndex:
+    """indexes the modulefiles available under modulepath roots
+
+    Each directory is listed with `os.scandir` and its listing is kept,
+    with the directory's modification time, in a JSON file.  A refresh
+    stats every known directory once and lists only those whose mtime
+    has changed, so modulefiles themselves are never stat'ed.  Adding or
+    removing a module changes the mtime of the directory holding it.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.directories: dict[str, dict[str, Any]] = {}
+        self.listed = 0
+        if path is not None and path.exists():
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError:
+                logger.warning("ignoring unreadable module index %s", path)
+            else:
+                if data.get("version") == self.VERSION:
+                    self.directories = data["directories"]
+
+    def refresh(self, roots: Iterable[str]):
+        """brings the listings of every directory under roots up to date"""
+        roots = [os.path.abspath(root) for root in roots]
+        visited: set[str] = set()
+        targets: set[str] = set()
+        pending = list(reversed(roots))
+        while pending:
+            directory = pending.pop()
+            if directory in visited:
+                continue
+            visited.add(directory)
+            entry = self.directories.get(directory)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+                if entry is None or entry["mtime"] != mtime:
+                    entry = self.list_directory(directory, mtime)
+            except OSError:
+                self.directories.pop(directory, None)
+                continue
+            self.directories[directory] = entry
+            for name in entry["dirs"]:
+                child = os.path.join(directory, name)
+                if name in entry["links"]:
+                    target = os.path.realpath(child)
+                    if target in targets:
+                        continue
+                    targets.add(target)
+                pending.append(child)
+        for directory in list(self.directories):
+            if directory not in visited and any(
+                directory.startswith(root + os.sep) or directory == root
+                for root in roots
+            ):
+                del self.directories[directory]
+
+    def list_directory(self, directory: str, mtime: int) -> dict[str, Any]:
+        """lists the modulefiles and subdirectories of directory"""
+        self.listed += 1
+        entry: dict[str, Any] = {"mtime": mtime, "dirs": [], "links": [], "files": []}
+        with os.scandir(directory) as items:
+            for item in items:
+                if item.name.startswith("."):
+                    continue
+                try:
+                    is_dir = item.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    entry["dirs"].append(item.name)
+                    if item.is_symlink():
+                        entry["links"].append(item.name)
+                else:
+                    entry["files"].append(item.name)
+        for names in ("dirs", "links", "files"):
+            entry[names].sort()
+        return entry
+
+    def modules(self, roots: Iterable[str]) -> set[str]:
+        """returns every `name/version` under roots, and each of their names
+
+        Names are included so a load without a version, which resolves
+        to a default, is found.
+        """
+        found: set[str] = set()
+        for root in roots:
+            root = os.path.abspath(root)
+            pending = [("", root)]
+            while pending:
+                prefix, directory = pending.pop()
+                entry = self.directories.get(directory)
+                if entry is None:
+                    continue
+                for name in entry["files"]:
+                    found.add(prefix + (name[:-4] if name.endswith(".lua") else name))
+                for name in entry["dirs"]:
+                    found.add(prefix + name)
+                    pending.append((f"{prefix}{name}/", os.path.join(directory, name)))
+        return found
+
+    def is_directory(self, path: str) -> bool:
+        """returns True if path was found as a directory by the last refresh"""
+        return os.path.abspath(path) in self.directories
+
+    def save(self):
+        """writes the index to its path"""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(
+            json.dumps(
+                {"version": self.VERSION, "directories": self.directories},
+                sort_keys=True,
+            ),
+            encoding="utf-8",
+        )
+
+
+def check_modules(
+    results: Iterable[BuildResult], index: ModuleIndex, roots: Iterable[str] = ()
+) -> list[str]:
+    """returns a problem for every load or MODULEPATH target that does not exist
+
+    Loads are looked up in the modules under roots and under every
+    modulepath the build prepends.  Targets that still hold variables are
+    left for the module system to expand.
+    """
+    results = list(results)
+    modulepaths = sorted(
+        {
+            path
+            for result in results
+            for path in result.references.get("modulepath", [])
+            if "$" not in path
+        }
+    )
+    search = list(dict.fromkeys([*map(str, roots), *modulepaths]))
+    index.refresh(search)
+    available = index.modules(search)
+    problems = []
+    for result in results:
+        for path in result.references.get("modulepath", []):
+            if "$" not in path and not index.is_directory(path):
+                problems.append(f"{result.path}: MODULEPATH {path} does not exist")
+        for name in result.references.get("load", []):
+            if "$" not in name and name not in available:
+                problems.append(f"{result.path}: module {name} was not found")
+    return problems
+
+
+SPIDER_CACHE = "spiderT.lua"
+SPIDER_TIMESTAMP = "system.txt"
+
+
+def lmod_version(version: str) -> str:
+    """returns the sortable form of a version recorded in Lmod's spider cache,
+    with every number zero padded and every word starred"""
+    parts = re.findall(r"\d+|[A-Za-z]+", version)
+    return ".".join(
+        [part.zfill(9) if part.isdigit() else f"*{part.lower()}" for part in parts]
+        + ["*zfinal"]
+    )
+
+
+def lua_value(value: Any, indent: str = "") -> str:
+    """returns value as a lua literal, with tables one entry per line"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, str):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        return '"' + escaped.replace("\n", "\\n") + '"'
+    inner = indent + "  "
+    if isinstance(value, dict):
+        entries = [
+            f"{inner}[{lua_value(key)}] = {lua_value(item, inner)},\n"
+            for key, item in sorted(value.items())
+        ]
+    else:
+        entries = [f"{inner}{lua_value(item, inner)},\n" for item in value]
+    return "{\n" + "".join(entries) + indent + "}" if entries else "{}"
+
+
+def write_spider_cache(
+    path: Path,
+    output_path: Path,
+    results: Iterable[BuildResult],
+    translator: type[Translator],
+    subtree: bool = False,
+) -> int:
+    """writes an Lmod spider cache of the scripts in results to path, and
+    returns the number of modules in it
+
+    `spiderT.lua` holds the name, file, help and whatis of every module
+    under the modulepath translator's scripts were written to, and the
+    modulepaths each one adds.  `system.txt` is written afterwards so
+    Lmod sees the cache as current.  The last input defining a script
+    wins, as it does for the script itself.
+    """
+    mpath = str(
+        (
+            Path(output_path) / translator.target if subtree else Path(output_path)
+        ).resolve()
+    )
+    entries = {entry["name"]: entry for result in results for entry in result.modules}
+    spider: dict[str, dict[str, Any]] = {}
+    edges: dict[str, dict[str, str]] = {}
+    for name, entry in entries.items():
+        sn, _, version = name.rpartition("/") if "/" in name else (name, "", "")
+        fields: dict[str, Any] = {
+            "fn": f"{mpath}/{translator.filename(name)}",
+            "fullName": name,
+            "help": entry["help"],
+            "mpath": mpath,
+            "whatis": entry["whatis"],
+        }
+        if entry["modulepaths"]:
+            fields["changeMPATH"] = True
+        for child in entry["modulepaths"]:
+            edges.setdefault(child, {})[name] = mpath
+        if not version:
+            spider.setdefault(sn, {})["metaModuleT"] = fields
+            continue
+        weight = lmod_version(version)
+        fields.update(Version=version, canonical=version, pV=weight, wV=weight)
+        spider.setdefault(sn, {}).setdefault("fileT", {})[name] = fields
+    text = (
+        "timestampFn = {\n  false,\n}\n"
+        "mrcT = {}\n"
+        "mrcMpathT = {}\n"
+        f"spiderT = {lua_value({mpath: spider})}\n"
+        f"mpathMapT = {lua_value(edges)}\n"
+    )
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    partial = path / f".{SPIDER_CACHE}.{os.getpid()}"
+    partial.write_text(text, encoding="utf-8")
+    os.replace(partial, path / SPIDER_CACHE)
+    (path / SPIDER_TIMESTAMP).write_text(f"{int(time.time())}\n", encoding="utf-8")
+    return len(entries)
+
+
+class Watcher:
+    """reports which input files have changed
+
+    Uses inotify when it is available and falls back to polling the
+    modification time and size of each input otherwise.  The parent
+    directories are watched so editors that save by renaming a new file
+    into place are still seen.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, paths: Iterable[Path], interval: float = 0.5, inotify=True):
+        self.paths = {Path(path).resolve(): Path(path) for path in paths}
+        self.interval = interval
+        self.directories: dict[int, Path] = {}
+        self.fd = self.open_inotify() if inotify else None
+        self.stats = {path: self.stat(path) for path in self.paths}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_inotify(self) -> Optional[int]:
+        """returns an inotify descriptor watching every input directory"""
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        for directory in sorted({path.parent for path in self.paths}):
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self.directories[wd] = directory
+        return fd
+
+    @staticmethod
+    def stat(path: Path) -> Optional[tuple[int, int]]:
+        """returns the modification time and size of path, or None if missing"""
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changes(self, timeout: Optional[float] = None) -> list[Path]:
+        """waits up to timeout seconds and returns the changed inputs in order"""
+        if self.fd is None:
+            changed = self.poll(timeout)
+        else:
+            changed = self.read_events(timeout)
+        return [path for resolved, path in self.paths.items() if resolved in changed]
+
+    def read_events(self, timeout: Optional[float]) -> set[Path]:
+        """reads inotify events, coalescing bursts into one set of paths
+
+        Events were dropped if the kernel's queue overflowed, so every
+        input is reported as changed.
+        """
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            buffer = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, length = self.EVENT.unpack_from(buffer, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflowed, rebuilding every input")
+                    changed.update(self.paths)
+                elif wd in self.directories:
+                    changed.add(self.directories[wd] / name)
+            ready, _, _ = select.select([self.fd], [], [], 0.05)
+        return changed
+
+    def poll(self, timeout: Optional[float]) -> set[Path]:
+        """polls input modification times until one changes or timeout expires"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, previous in self.stats.items():
+                current = self.stat(path)
+                if current != previous:
+                    self.stats[path] = current
+                    changed.add(path)
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        """stops watching"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch(
+    paths: list[Path],
+    results: list[BuildResult],
+    options: BuildOptions,
+    incremental: bool = False,
+    watcher: Optional[Watcher] = None,
+):
+    """rebuilds the scripts of each input as it changes until interrupted
+
+    Only the changed file is re-parsed and rewritten.  Scripts it no
+    longer defines are removed, and a timing line is logged per event.
+    The files of the options' library are watched too, and a change to
+    one rebuilds every input that includes its fragments.  The options'
+    spider cache is rewritten after every change.
+    """
+    manifest = Manifest(options.output_path, options.targets, options.loader)
+    latest = {}
+    for result in results:
+        manifest.update(result)
+        latest[result.path] = result
+    library = options.library
+    library_files = library.paths if library is not None else []
+    watcher = watcher or Watcher([*paths, *library_files])
+    logger.info(
+        "watching %d files (%s)",
+        len(paths),
+        "polling" if watcher.fd is None else "inotify",
+    )
+    with watcher:
+        try:
+            while True:
+                for path in watcher.changes():
+                    for target in changed_inputs(path, options, manifest, latest):
+                        latest[target] = rebuild(target, options, manifest, incremental)
+                    if options.spider_cache is not None:
+                        write_spider_cache(
+                            options.spider_cache,
+                            options.output_path,
+                            latest.values(),
+                            TARGETS[options.targets[0]],
+                            options.subtree,
+                        )
+        except KeyboardInterrupt:
+            logger.info("stopped watching")
+
+
+def changed_inputs(
+    path: Path,
+    options: BuildOptions,
+    manifest: Manifest,
+    latest: dict[Path, BuildResult],
+) -> list[Path]:
+    """returns the inputs to rebuild after path changed
+
+    A changed library file is reparsed and its translated fragments are
+    dropped, and every input including one of its fragments is returned.
+    """
+    library = options.library
+    if library is None or path not in library.paths:
+        return [path]
+    try:
+        changed = library.refresh()
+    except build_errors() as error:
+        logger.error("failed to reload %s (%s)", path, error)
+        return []
+    options.imported.clear()
+    manifest.digests.clear()
+    dependents = library.dependents(latest.values(), changed)
+    logger.info(
+        "%s changed, rebuilding %d dependents: %s",
+        path,
+        len(dependents),
+        ", ".join(str(dependent) for dependent in dependents),
+    )
+    return dependents
+
+
+def rebuild(
+    path: Path, options: BuildOptions, manifest: Manifest, save: bool = False
+) -> BuildResult:
+    """rebuilds a single changed input and logs how long it took"""
+    start = time.perf_counter()
+    result = build_file(path, options)
+    manifest.update(result)
+    manifest.remove_stale()
+    if save:
+        manifest.save()
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.ok:
+        logger.info(
+            "rebuilt %s: %d scripts in %.1f ms", path, len(result.scripts), elapsed
+        )
+    else:
+        logger.error(
+            "failed to rebuild %s in %.1f ms (%s)", path, elapsed, result.error
+        )
+    return result
+
+
+class Server:
+    """serves render and build requests over a local Unix socket
+
+    Requests and responses are single lines of JSON.  Each request names
+    an `op` and may carry an `id` that is echoed back on its response,
+    along with `ok` and the time it took in `elapsed_ms`.  Requests on
+    every connection, and on a single connection, are handled
+    concurrently in a thread pool, and parsed inputs are kept warm in a
+    `ParseCache` shared by every request.
+
+    Variables are resolved from the request's `context` values when it
+    has them, or from a snapshot of the server's environment otherwise.
+    """
+
+    operations = {
+        "ping": "ping",
+        "status": "status",
+        "render": "render",
+        "build": "build",
+        "shutdown": "ping",
+    }
+
+    LINE_LIMIT = 1 << 26
+
+    def __init__(
+        self,
+        socket_path: Path,
+        context: Optional[ResolutionContext] = None,
+        workers: Optional[int] = None,
+    ):
+        self.socket_path = Path(socket_path)
+        self.context = context or ResolutionContext.from_sources()
+        self.workers = workers
+        self.cache = ParseCache()
+        self.libraries: dict[tuple[tuple[str, ...], str], FragmentLibrary] = {}
+        self.library_lock = threading.Lock()
+        self.requests = 0
+        self.executor: Optional[futures.ThreadPoolExecutor] = None
+        self.ready = threading.Event()
+        self.stopped: Optional[asyncio.Event] = None
+
+    def run(self):
+        """serves requests until a shutdown request or an interrupt"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("stopped serving")
+
+    async def serve(self):
+        """listens on the socket until stopped"""
+        self.stopped = asyncio.Event()
+        self.remove_stale_socket()
+        server = await asyncio.start_unix_server(
+            self.handle, path=str(self.socket_path), limit=self.LINE_LIMIT
+        )
+        executor = self.executor = futures.ThreadPoolExecutor(
+            self.workers, "wrangler-serve"
+        )
+        logger.info("serving on %s", self.socket_path)
+        self.ready.set()
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+            self.socket_path.unlink(missing_ok=True)
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.ready.clear()
+
+    def remove_stale_socket(self):
+        """removes a socket left behind by a server that is no longer running"""
+        if not self.socket_path.exists():
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(str(self.socket_path))
+            except ConnectionRefusedError:
+                self.socket_path.unlink()
+                return
+        raise OSError(f"a server is already listening on {self.socket_path}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """answers every request on a connection until the client closes it
+
+        Connections still open when the server stops are cancelled, and
+        closed quietly rather than left for asyncio to report.
+        """
+        lock = asyncio.Lock()
+        tasks: set[asyncio.Task] = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.respond(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, ValueError) as error:
+            logger.warning("dropped connection (%s)", error)
+        except asyncio.CancelledError:
+            logger.debug("closed a connection open at shutdown")
+        finally:
+            writer.close()
+
+    async def respond(
+        self, line: bytes, writer: asyncio.StreamWriter, lock: asyncio.Lock
+    ):
+        """runs one request in the thread pool and writes its response"""
+        start = time.perf_counter()
+        request: dict[str, Any] = {}
+        try:
+            request = json.loads(line)
+            method = getattr(self, self.operations[request["op"]])
+            response = await asyncio.get_running_loop().run_in_executor(
+                self.executor, method, request
             )
+        except (KeyError, TypeError, AttributeError) as error:
+            response = {"ok": False, "error": f"invalid request ({error!r})"}
+        except build_errors() as error:
+            response = {"ok": False, "error": f"{type(error).__name__}: {error}"}
+        except Exception as error:
+            logger.exception("unexpected error answering a request")
+            response = {"ok": False, "error": f"{type(error).__name__}: {error}"}
+        self.requests += 1
+        response["id"] = request.get("id") if isinstance(request, dict) else None
+        response["elapsed_ms"] = (time.perf_counter() - start) * 1000
+        async with lock:
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        if isinstance(request, dict) and request.get("op") == "shutdown":
+            self.stopped.set()
+
+    def request_context(self, request: dict[str, Any]) -> ResolutionContext:
+        """returns a fresh resolution context for a request"""
+        values = request.get("context")
+        return ResolutionContext(self.context.values if values is None else values)
+
+    def request_library(self, request: dict[str, Any]) -> Optional[FragmentLibrary]:
+        """returns the fragment library of a request, kept for the session and
+        reparsed only where its files changed"""
+        paths = tuple(request.get("library") or ())
+        if not paths:
+            return None
+        key = (paths, request.get("loader", "auto"))
+        with self.library_lock:
+            library = self.libraries.get(key)
+            if library is None:
+                library = self.libraries[key] = FragmentLibrary(
+                    [Path(path) for path in paths], key[1]
+                )
+            else:
+                library.refresh()
+        return library
+
+    def ping(self, request: dict[str, Any]) -> dict[str, Any]:
+        """answers that the server is running"""
+        return {"ok": True}
+
+    def status(self, request: dict[str, Any]) -> dict[str, Any]:
+        """reports the requests served and the state of the parse cache"""
+        return {
+            "ok": True,
+            "requests": self.requests,
+            "cached": len(self.cache.entries),
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+        }
+
+    def render(self, request: dict[str, Any]) -> dict[str, Any]:
+        """renders inline yaml `sources` and input `paths`
+
+        Scripts are returned in the response, or written to `output_path`
+        in `output_format` when one is given.  Errors refer to inputs by
+        their index in `sources` followed by `paths`.
+        """
+        loader = request.get("loader", "auto")
+        renderer = Renderer(self.request_context(request), loader)
+        inputs = list(request.get("sources", []))
+        inputs.extend(Path(path) for path in request.get("paths", []))
+        result = RenderResult()
+        for idx, source in enumerate(inputs):
+            if isinstance(source, Path):
+                try:
+                    source = self.cache.load(source, loader)[1]
+                except build_errors() as error:
+                    message = f"{type(error).__name__}: {error}"
+                    result.errors.append(RenderError(idx, None, message))
+                    continue
+                if source is None:
+                    continue
+                if not isinstance(source, dict):
+                    message = (
+                        "AttributeError: yaml documents must be mappings of scripts"
+                    )
+                    result.errors.append(RenderError(idx, None, message))
+                    continue
+            renderer.render_source(idx, source, result)
+        response: dict[str, Any] = {
+            "ok": result.ok,
+            "errors": [error.as_dict() for error in result.errors],
+        }
+        if request.get("output_path") is None:
+            response["scripts"] = result.scripts
+            return response
+        output_path = Path(request["output_path"])
+        output_format = request.get("output_format", "files")
+        prepare_output_path(output_path, output_format)
+        with OUTPUT_FORMATS[output_format](output_path) as writer:
+            for name, text in result.scripts.items():
+                writer.write(f"{name}.lua", text)
+        response["scripts"] = list(result.scripts)
+        return response
+
+    def build(self, request: dict[str, Any]) -> dict[str, Any]:
+        """builds input `paths` to `output_path` as the command line would"""
+        output_path = Path(request["output_path"])
+        output_format = request.get("output_format", "files")
+        prepare_output_path(output_path, output_format)
+        stats = Stats() if request.get("stats") else None
+        wall, cpu = time.perf_counter(), time.thread_time()
+        results = build(
+            [Path(path) for path in request["paths"]],
+            output_path,
+            jobs=request.get("jobs", 1),
+            incremental=request.get("incremental", False),
+            loader=request.get("loader", "auto"),
+            stream=request.get("stream", False),
+            output_format=output_format,
+            context=self.request_context(request),
+            stats=stats,
+            io_threads=request.get("io_threads", 0),
+            cache=self.cache,
+            targets=request.get("targets", ("lua",)),
+            library=self.request_library(request),
+            optimize=request.get("optimize", False),
+            spider_cache=(
+                Path(request["spider_cache"]) if request.get("spider_cache") else None
+            ),
+            dedup=request.get("dedup", False),
+        )
+        response = {
+            "ok": all(result.ok for result in results),
+            "results": [result.as_dict() for result in results],
+            "unresolved": unresolved_variables(results),
+        }
+        if request.get("optimize", False):
+            lines, size = total_saved(results)
+            response["saved"] = {"lines": lines, "bytes": size}
+        if stats is not None:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            response["stats"] = stats.report(wall, cpu)
+        return response
+
+
+def prepare_output_path(output_path: Path, output_format: str = "files"):
+    """creates the output directory, or the parent directory of a bundle"""
+    if output_format == "files":
+        output_path.mkdir(parents=True, exist_ok=True)
+    else:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+
+class Client:
+    """a thin client for a running `wrangler serve`
+
+    Each request is sent as one line of JSON over the server's Unix
+    socket, and `request` blocks until its response arrives.  The
+    connection is opened on first use and reused until `close`.
+    """
+
+    def __init__(self, socket_path: Path, timeout: Optional[float] = None):
+        self.socket_path = Path(socket_path)
+        self.timeout = timeout
+        self.connection: Optional[socket.socket] = None
+        self.stream = None
+        self.ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """opens the connection to the server if it is not already open"""
+        if self.connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            try:
+                connection.connect(str(self.socket_path))
+            except OSError:
+                connection.close()
+                raise
+            self.connection = connection
+            self.stream = connection.makefile("rwb")
+
+    def request(self, op: str, **fields) -> dict[str, Any]:
+        """sends a request and returns the server's response"""
+        self.connect()
+        payload = {"id": next(self.ids), "op": op, **fields}
+        self.stream.write(json.dumps(payload).encode("utf-8") + b"\n")
+        self.stream.flush()
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError(f"{self.socket_path} closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        """closes the connection to the server"""
+        if self.connection is not None:
+            self.stream.close()
+            self.connection.close()
+            self.connection = None
+            self.stream = None
+
+
+def forward(socket_path: Path, paths: list[Path], data: dict[str, Any]) -> int:
+    """forwards a build to a running server and reports it as `main` would
+
+    Inputs and the output path are sent as absolute paths and variables
+    are resolved from the client's context.  The build is abandoned if
+    the server does not answer within the server timeout.  Returns the
+    exit status.
+    """
+    request = {
+        "paths": [str(Path(path).resolve()) for path in paths],
+        "output_path": str(Path(data["output_path"]).resolve()),
+        "jobs": data["jobs"],
+        "incremental": data["incremental"],
+        "loader": data["loader"],
+        "stream": data["stream"],
+        "output_format": data["output_format"],
+        "io_threads": data["io_threads"],
+        "targets": data.get("targets", ("lua",)),
+        "library": [str(Path(path).resolve()) for path in data.get("library", ())],
+        "optimize": data.get("optimize", False),
+        "dedup": data.get("dedup", False),
+        "spider_cache": (
+            str(Path(data["spider_cache"]).resolve())
+            if data.get("spider_cache") is not None
+            else None
+        ),
+        "stats": data["stats"] is not None,
+        "context": data["context"].values,
+    }
+    timeout = data.get("server_timeout", SERVER_TIMEOUT)
+    try:
+        with Client(socket_path, timeout) as client:
+            response = client.request("build", **request)
+    except socket.timeout:
+        logger.error("the server at %s did not answer in %gs", socket_path, timeout)
+        return 2
+    except (OSError, ValueError) as error:
+        logger.error("unable to reach the server at %s (%s)", socket_path, error)
+        return 2
+    if "results" not in response:
+        logger.error("the server could not build (%s)", response.get("error"))
+        return 2
+    for result in response["results"]:
+        if result["error"] is not None:
+            logger.error("failed to build %s (%s)", result["path"], result["error"])
+    unresolved = response["unresolved"]
+    if unresolved:
+        logger.warning(
+            "%d unresolved variables: %s", len(unresolved), ", ".join(unresolved)
+        )
+    logger.info(
+        "server built %d files in %.1f ms",
+        len(response["results"]),
+        response["elapsed_ms"],
+    )
+    if "saved" in response:
+        logger.info(
+            "optimizing saved %d lines (%d bytes)",
+            response["saved"]["lines"],
+            response["saved"]["bytes"],
+        )
+    if "stats" in response:
+        print(json.dumps(response["stats"], indent=2))
+    if data["unresolved_report"] is not None:
+        data["unresolved_report"].write_text(
+            json.dumps(unresolved, indent=2), encoding="utf-8"
+        )
+    return 0 if response["ok"] else 1
+
+
+def extract_main(argv: list[str]) -> int:
+    """materializes a bundle written with --output-format"""
+    parser = argparse.ArgumentParser(
+        prog="wrangler extract",
+        description="Extracts a tar, zip or sqlite bundle of lua scripts",
+        epilog="Example: wrangler extract --output-path ./modules bundle.tar",
+    )
+    parser.add_argument("bundle", type=pathlib.Path, help="the bundle to extract")
+    parser.add_argument(
+        "--output-path",
+        type=pathlib.Path,
+        help="the directory scripts are extracted to",
+        required=True,
+    )
+    args = parser.parse_args(argv)
+    try:
+        count = extract_bundle(args.bundle, args.output_path)
+    except (
+        OSError,
+        ValueError,
+        tarfile.TarError,
+        zipfile.BadZipFile,
+        sqlite3.DatabaseError,
+    ) as error:
+        logger.error("failed to extract %s (%s)", args.bundle, error)
+        return 1
+    logger.info("extracted %d scripts to %s", count, args.output_path)
+    return 0
+
+
+def serve_main(argv: list[str]) -> int:
+    """runs a long-lived server that builds and renders on request"""
+    parser = argparse.ArgumentParser(
+        prog="wrangler serve",
+        description="Serves render and build requests over a Unix socket",
+        epilog="Example: wrangler serve --socket /tmp/wrangler.sock",
+    )
+    parser.add_argument(
+        "--socket",
+        type=pathlib.Path,
+        help="the path of the Unix socket to listen on",
+        required=True,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of requests handled at once (defaults to the pool default)",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        default="INFO",
+        help="logging verbosity",
+    )
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(args.log_level)
+    try:
+        Server(args.socket, workers=args.workers).run()
+    except OSError as error:
+        logger.error("unable to serve on %s (%s)", args.socket, error)
+        return 1
+    return 0
+
+
+def merge_main(argv: list[str]) -> int:
+    """checks that the shards of a sharded build produced every script once"""
+    parser = argparse.ArgumentParser(
+        prog="wrangler merge",
+        description="Checks the manifests written by each --shard of a build",
+        epilog="Example: wrangler merge ./modules",
+    )
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        type=pathlib.Path,
+        help="shard manifests, or output directories holding them",
+    )
+    args = parser.parse_args(argv)
+    manifests = []
+    for _path in args.paths:
+        files = (
+            sorted(_path.glob(".wrangler-shard-*-of-*.json"))
+            if _path.is_dir()
+            else [_path]
+        )
+        for _file in files:
+            try:
+                manifests.append(json.loads(_file.read_text(encoding="utf-8")))
+            except (OSError, ValueError) as error:
+                logger.error("unable to read shard manifest %s (%s)", _file, error)
+                return 1
+    if not manifests:
+        logger.error("no shard manifests found")
+        return 1
+    problems = merge_shards(manifests)
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        return 1
+    scripts = sum(
+        len(entry["scripts"])
+        for manifest in manifests
+        for entry in manifest["inputs"].values()
+    )
+    logger.info("%d shards produced %d scripts once each", len(manifests), scripts)
+    return 0
+
+
+COMMANDS = {"extract": extract_main, "merge": merge_main, "serve": serve_main}
 
 
 def main():
     """main execution"""
 
     logging.basicConfig(
-        level=logging.DEBUG,
+        level=logging.INFO,
         format="%(asctime)s %(levelname)s %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    logger.setLevel(logging.DEBUG)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
 
     data = CLI().get_user_input()
-    inputs: Generator[Path, None, None] = data["queue"]
+    logging.getLogger().setLevel(data["log_level"])
+    libraries = {_file.resolve() for _file in data["library"]}
+    inputs = [_file for _file in data["queue"] if _file.resolve() not in libraries]
     output_path: Path = data["output_path"]
+    if data["server"] is not None:
+        sys.exit(forward(data["server"], inputs, data))
 
-    for scripts in queue(inputs):
-        write_scripts_to_files(scripts, output_path)
-    sys.exit(0)
+    library = None
+    if data["library"]:
+        try:
+            library = FragmentLibrary(data["library"], data["loader"])
+        except build_errors() as error:
+            logger.error("unable to load the fragment library (%s)", error)
+            sys.exit(2)
+    stats = Stats() if data["stats"] else None
+    profiler = cProfile.Profile() if data["profile"] else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    results = build(
+        inputs,
+        output_path,
+        jobs=data["jobs"],
+        incremental=data["incremental"],
+        loader=data["loader"],
+        stream=data["stream"],
+        output_format=data["output_format"],
+        context=data["context"],
+        stats=stats,
+        io_threads=data["io_threads"],
+        targets=data["targets"],
+        data_cache=data["data_cache"],
+        shard=data["shard"],
+        library=library,
+        optimize=data["optimize"],
+        spider_cache=data["spider_cache"],
+        dedup=data["dedup"],
+    )
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(data["profile"])
+        logger.info("wrote profile to %s", data["profile"])
+    if stats is not None:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        print(json.dumps(stats.report(wall, cpu), indent=2))
+    if data["unresolved_report"] is not None:
+        data["unresolved_report"].write_text(
+            json.dumps(unresolved_variables(results), indent=2), encoding="utf-8"
+        )
+    problems = []
+    if data["check_modules"]:
+        index = ModuleIndex(data["module_index"])
+        problems = check_modules(results, index, data["modulepaths"])
+        for problem in problems:
+            logger.error(problem)
+        index.save()
+    if data["watch"]:
+        options = BuildOptions(
+            output_path,
+            data["loader"],
+            data["stream"],
+            context=data["context"],
+            targets=data["targets"],
+            shard=data["shard"],
+            library=library,
+            optimize=data["optimize"],
+            spider_cache=data["spider_cache"],
+            dedup=data["dedup"],
+        )
+        watch(inputs, results, options, data["incremental"])
+    sys.exit(0 if all(result.ok for result in results) and not problems else 1)
 
 
 if __name__ == "__main__":